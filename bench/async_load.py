@@ -0,0 +1,100 @@
+# load test: sync vs async /user/<user> over a real socket, against a
+# stand-in backend that sleeps on every storage call (a "remote" DB).
+# run from the repo root: `python -m bench.async_load`
+import http.client
+import logging
+import statistics
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from pt7.app import StorageMem, app, seed
+
+LATENCIES = (0.001, 0.005, 0.02)
+CLIENTS = 16
+REQUESTS_PER_CLIENT = 50
+PATHS = {"sync": "/user/a", "async": "/async/user/a"}
+
+
+class StorageSlow:
+    def __init__(self, sto, latency):
+        self.sto = sto
+        self.latency = latency
+
+    def __getattr__(self, name):
+        fn = getattr(self.sto, name)
+
+        def slow(*args):
+            time.sleep(self.latency)
+            return fn(*args)
+
+        return slow
+
+
+def login(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request(
+        "POST",
+        "/login",
+        body="username=a&password=1234",
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    resp = conn.getresponse()
+    resp.read()
+    return resp.getheader("Set-Cookie").split(";")[0]
+
+
+def client(port, path, cookie, latencies):
+    for _ in range(REQUESTS_PER_CLIENT):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        start = time.perf_counter()
+        conn.request("GET", path, headers={"Cookie": cookie})
+        resp = conn.getresponse()
+        resp.read()
+        latencies.append(time.perf_counter() - start)
+        assert resp.status == 200, resp.status
+        conn.close()
+
+
+def run(port, path, cookie):
+    latencies = []
+    threads = [
+        threading.Thread(target=client, args=(port, path, cookie, latencies))
+        for _ in range(CLIENTS)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    p99 = statistics.quantiles(latencies, n=100)[98]
+    return len(latencies) / elapsed, p99
+
+
+def main():
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app.secret_key = "bench"
+    app.extensions["page_cache"] = None
+    sto = StorageMem()
+    seed(sto)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        app.extensions["storage"] = sto
+        cookie = login(server.port)
+        for latency in LATENCIES:
+            app.extensions["storage"] = StorageSlow(sto, latency)
+            for name, path in PATHS.items():
+                rps, p99 = run(server.port, path, cookie)
+                print(
+                    f"latency {latency * 1e3:4.0f} ms  {name:5}"
+                    f" {rps:8.1f} req/s  p99 {p99 * 1e3:7.2f} ms"
+                )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
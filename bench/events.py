@@ -0,0 +1,85 @@
+# live inbox fan-out: 5k subscribers on one inbox, each on its own thread
+# reading the SSE stream (iter_events, i.e. everything but the socket).
+# Messages carry their send time; we report publish -> delivery latency,
+# and that subscribers which stop reading get dropped (and nobody else)
+# run from the repo root: `python -m bench.events [--subscribers N]`
+import argparse
+import json
+import statistics
+import threading
+import time
+
+from pt7.app import Broker, Message, iter_events
+
+MESSAGES = 50
+INTERVAL = 0.02  # seconds between messages
+
+
+def subscriber(broker, size, stall, latencies, ready, sent_all, done):
+    sub = broker.subscribe("a", size)
+    events = iter_events(broker, sub, keepalive=1.0)
+    next(events)  # connected
+    ready.release()
+    got = 0
+    for event in events:
+        if event.startswith("event: dropped"):
+            break
+        if not event.startswith("event: message"):
+            continue
+        sent = json.loads(event.split("data: ", 1)[1])["msg"]
+        latencies.append(time.perf_counter() - float(sent))
+        got += 1
+        if got == MESSAGES:
+            break
+        if stall:
+            sent_all.wait()  # a stuck client: it's far behind by now
+    events.close()
+    done.release()
+
+
+def run(n, stall_every, size):
+    broker = Broker()
+    latencies = []
+    ready = threading.Semaphore(0)
+    sent_all = threading.Event()
+    done = threading.Semaphore(0)
+    threading.stack_size(256 * 1024)
+    for i in range(n):
+        stall = stall_every and i % stall_every == 0
+        threading.Thread(
+            target=subscriber,
+            args=(broker, size, stall, latencies, ready, sent_all, done),
+            daemon=True,
+        ).start()
+    for _ in range(n):
+        ready.acquire()
+    publish = []
+    for _ in range(MESSAGES):
+        start = time.perf_counter()
+        broker.publish("a", Message("b", repr(start)))
+        publish.append(time.perf_counter() - start)
+        time.sleep(INTERVAL)
+    sent_all.set()
+    for _ in range(n):
+        done.acquire()
+    q = statistics.quantiles(latencies, n=100)
+    print(
+        f"subscribers={n:<5} stall=1/{stall_every or '-':<4} buffer={size:<4}"
+        f" delivered={len(latencies):<7} dropped={broker.dropped:<4}"
+        f" publish p50 {statistics.median(publish) * 1e3:6.2f} ms"
+        f"  latency p50 {q[49] * 1e3:7.2f}  p99 {q[98] * 1e3:7.2f}"
+        f"  max {max(latencies) * 1e3:7.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.events")
+    parser.add_argument("--subscribers", type=int, default=5_000)
+    parser.add_argument("--buffer", type=int, default=16)
+    args = parser.parse_args()
+    run(args.subscribers, 0, args.buffer)
+    run(args.subscribers, 100, args.buffer)  # 1% stop reading
+
+
+if __name__ == "__main__":
+    main()
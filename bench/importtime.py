@@ -0,0 +1,73 @@
+# worker cold start: `python -X importtime -c "import pt7.app"` (best of a
+# few runs), then import + create_app. Exits 1 if the import went over
+# budget, or if a module we keep lazy got imported at startup again.
+# run from the repo root: `python -m bench.importtime [--budget-ms N]`
+import argparse
+import compileall
+import subprocess
+import sys
+
+RUNS = 5
+BUDGET_MS = 400.0  # this box; pass --budget-ms on yours
+# only the code paths that need these import them
+LAZY = ("pytest", "asyncio", "sqlite3", "multiprocessing.managers")
+PREFIX = "import time:"
+BOOT = (
+    "import time; s = time.perf_counter(); import pt7.app; "
+    "pt7.app.create_app(); print(time.perf_counter() - s)"
+)
+
+
+def importtime():
+    # stderr lines: "import time: self [us] | cumulative | imported package"
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import pt7.app"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    modules = {}
+    for line in out.splitlines():
+        if not line.startswith(PREFIX) or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix(PREFIX).split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.importtime")
+    parser.add_argument("--budget-ms", type=float, default=BUDGET_MS)
+    args = parser.parse_args()
+    # workers run from .pyc; don't time compiling the source
+    compileall.compile_dir("pt7", quiet=1)
+    runs = [importtime() for _ in range(RUNS)]
+    modules = min(runs, key=lambda m: m["pt7.app"][1])
+    total_ms = modules["pt7.app"][1] / 1e3
+    slowest = sorted(modules.items(), key=lambda kv: kv[1][0], reverse=True)
+    for name, (self_us, cumulative_us) in slowest[:10]:
+        print(
+            f"{self_us / 1e3:8.2f} ms self {cumulative_us / 1e3:8.2f} ms"
+            f"  {name}"
+        )
+    boot = subprocess.run(
+        [sys.executable, "-c", BOOT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    print(f"import pt7.app {total_ms:8.2f} ms (budget {args.budget_ms} ms)")
+    print(f"import + create_app {float(boot.stdout) * 1e3:8.2f} ms")
+    failed = False
+    if total_ms > args.budget_ms:
+        print("FAIL: import over budget")
+        failed = True
+    for name in LAZY:
+        if name in modules:
+            print(f"FAIL: {name} imported at startup")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# StorageLog: append throughput, then startup index rebuild over the whole
+# log (default 10M messages; BENCH_LOG_MESSAGES=... to change), then reads.
+# run from the repo root: `python -m bench.log`
+import os
+import tempfile
+import time
+
+from pt7.app import Message, StorageLog
+
+MESSAGES = int(os.environ.get("BENCH_LOG_MESSAGES", 10_000_000))
+USERS = 10_000
+BATCH = 10_000
+
+
+def main():
+    users = [f"user{i}" for i in range(USERS)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "log")
+        sto = StorageLog(path)
+        sto.add_users(users)
+        start = time.perf_counter()
+        for i in range(0, MESSAGES, BATCH):
+            n = min(BATCH, MESSAGES - i)
+            sto.add_messages_bulk(
+                [
+                    (users[(i + j) % USERS], Message("a", "hello"))
+                    for j in range(n)
+                ]
+            )
+        elapsed = time.perf_counter() - start
+        sto.close()
+        size = sum(
+            os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+        )
+        print(
+            f"append   {MESSAGES:,} msgs {elapsed:7.2f} s"
+            f"  {MESSAGES / elapsed:10,.0f} msg/s  {size / 2**20:,.0f} MB"
+        )
+
+        start = time.perf_counter()
+        sto = StorageLog(path)
+        elapsed = time.perf_counter() - start
+        print(
+            f"rebuild  {MESSAGES:,} msgs {elapsed:7.2f} s"
+            f"  {MESSAGES / elapsed:10,.0f} msg/s"
+        )
+
+        reads = 1_000
+        start = time.perf_counter()
+        for i in range(reads):
+            sto.get_messages_page(users[i % USERS], None, 50)
+        elapsed = time.perf_counter() - start
+        print(f"read     50-msg page {elapsed / reads * 1e6:8.1f} us")
+        sto.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# /login POST throughput at several KDF costs, with and without the
+# verified-cred cache. run from the repo root: `python -m bench.login`
+import threading
+import time
+
+from pt7.app import (
+    Kdf,
+    StorageMem,
+    app,
+    hash_cred,
+    init_cred_checker,
+    seed_users,
+)
+
+LEVELS = (
+    Kdf("pbkdf2_sha256", 10_000),
+    Kdf("pbkdf2_sha256", 100_000),
+    Kdf("pbkdf2_sha256", 600_000),
+    Kdf("scrypt", 2**12),
+    Kdf("scrypt", 2**14),
+    Kdf("scrypt", 2**15),
+)
+THREADS = 8
+LOGINS_PER_THREAD = 10
+
+
+def login(n, failed):
+    client = app.test_client()
+    for _ in range(n):
+        resp = client.post(
+            "/login", data={"username": "a", "password": "1234"}
+        )
+        if resp.status_code != 302:
+            failed.append(resp.status_code)
+
+
+def run():
+    failed = []
+    threads = [
+        threading.Thread(target=login, args=(LOGINS_PER_THREAD, failed))
+        for _ in range(THREADS)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    # a 429/503 is cheap; counting those would inflate req/s
+    if failed:
+        raise RuntimeError(f"POST /login: {sorted(set(failed))}")
+    return THREADS * LOGINS_PER_THREAD / elapsed
+
+
+def main():
+    app.secret_key = "bench"
+    app.extensions["page_cache"] = None
+    app.extensions["rate_limits"] = {}  # measuring the KDF, not the limits
+    for kdf in LEVELS:
+        sto = StorageMem()
+        seed_users(sto)
+        sto.set_cred("a", hash_cred("1234", kdf))
+        app.extensions["storage"] = sto
+        line = f"{kdf.name:14} cost={kdf.cost:>7}"
+        for label, ttl in (("no cache", 0), ("cached", 300)):
+            init_cred_checker(app, workers=4, ttl=ttl)
+            line += f"  {label} {run():8.1f} req/s"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
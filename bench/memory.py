@@ -0,0 +1,46 @@
+# memory: StorageMem message layouts at 1M messages, measured by tracemalloc
+# run from the repo root: `python -m bench.memory`
+import time
+import tracemalloc
+
+from pt7.app import Message, StorageMem
+
+MESSAGES = 1_000_000
+USERS = 10_000
+
+
+def measure(compact):
+    users = [f"user{i}" for i in range(USERS)]
+    tracemalloc.start()
+    sto = StorageMem(compact=compact)
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        # each body is made in the traced window, as if from a request: the
+        # list layout keeps it (counted), compact copies it and drops it
+        body = f"message body number {i}"
+        sto.add_message(
+            users[i % USERS], Message(users[(i + 1) % USERS], body)
+        )
+    del body
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for user in users[:1000]:
+        sto.get_messages(user)
+    read = time.perf_counter() - start
+    return current, elapsed, read
+
+
+def main():
+    for name, compact in (("list", False), ("compact", True)):
+        current, elapsed, read = measure(compact)
+        print(
+            f"{name:8} {current / 2**20:8.1f} MB"
+            f"  {current / MESSAGES:6.1f} B/msg"
+            f"  add {elapsed:5.2f} s  read 1k inboxes {read * 1e3:7.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# microbenchmark: what one span costs (timed vs bare call), and GET
+# /user/a through the test client with and without the metrics middleware
+# run from the repo root: `python -m bench.metrics`
+import timeit
+
+from pt7.app import (
+    Metrics,
+    MetricsMiddleware,
+    PageCache,
+    StorageMem,
+    StorageTimed,
+    SPANS,
+    app,
+    seed,
+)
+
+N = 200_000
+REQUESTS = 1_000
+
+
+def noop():
+    pass
+
+
+def spans():
+    metrics = Metrics()
+    timed = metrics.timed("noop", noop)
+    bare = timeit.timeit(noop, number=N) / N
+    for label, ctx in (("no request", None), ("in request", {})):
+        token = SPANS.set(ctx)
+        t = timeit.timeit(timed, number=N) / N
+        SPANS.reset(token)
+        print(f"span {label:10} {(t - bare) * 1e6:6.2f} us overhead/call")
+
+
+def requests():
+    app.secret_key = "bench"
+    wsgi_app = app.wsgi_app
+    for label in ("off", "on"):
+        sto = StorageMem()
+        seed(sto)
+        app.extensions["page_cache"] = PageCache(
+            0
+        )  # no cache: every span runs
+        if label == "on":
+            metrics = Metrics()
+            sto = StorageTimed(sto, metrics)
+            app.wsgi_app = MetricsMiddleware(wsgi_app, metrics)
+        app.extensions["storage"] = sto
+        client = app.test_client()
+        client.post("/login", data={"username": "a", "password": "1234"})
+        # best of a few: this box is noisy
+        t = min(
+            timeit.repeat(
+                lambda: client.get("/user/a"), number=REQUESTS, repeat=5
+            )
+        )
+        print(f"metrics {label:3} {t / REQUESTS * 1e6:8.1f} us/request")
+    app.wsgi_app = wsgi_app
+
+
+def main():
+    spans()
+    requests()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# request throughput as worker processes scale, all sharing one storage
+# process over a Unix socket (STORAGE_BACKEND=remote). Workers are forked
+# onto one listening socket, like a prefork server (gunicorn sync workers).
+# run from the repo root: `python -m bench.multiproc`
+import contextlib
+import http.client
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+
+import flask.sessions
+from werkzeug.serving import make_server
+
+from pt7.app import (
+    StorageRemote,
+    StorageSharded,
+    app,
+    make_storage_server,
+    seed,
+)
+
+AUTHKEY = b"bench"
+PROCESSES = (1, 2, 4, 8)
+CLIENTS = 8
+SECONDS = 3.0
+
+
+def serve_storage(address):
+    sto = StorageSharded()
+    seed(sto)
+    with contextlib.suppress(SystemExit):
+        make_storage_server(address, AUTHKEY, sto).serve_forever()
+
+
+def serve_app(address, fd):
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app.extensions["storage"] = StorageRemote(address, AUTHKEY)
+    make_server("127.0.0.1", 0, app, fd=fd).serve_forever()
+
+
+def request(port, method, path, cookie=None, body=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    if cookie:
+        headers["Cookie"] = cookie
+    conn.request(method, path, body=body, headers=headers)
+    resp = conn.getresponse()
+    resp.read()
+    conn.close()
+    return resp
+
+
+def client(port, cookie, _):
+    n = 0
+    deadline = time.perf_counter() + SECONDS
+    while time.perf_counter() < deadline:
+        assert request(port, "GET", "/user/a", cookie).status == 200
+        n += 1
+    return n
+
+
+def main():
+    # every worker must know every session: signed cookies do, per-process
+    # server-side session stores don't
+    app.session_interface = flask.sessions.SecureCookieSessionInterface()
+    app.secret_key = "bench"
+    app.extensions["page_cache"] = None
+    ctx = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as tmp:
+        address = os.path.join(tmp, "storage.sock")
+        storage = ctx.Process(target=serve_storage, args=(address,))
+        storage.start()
+        while not os.path.exists(address):
+            time.sleep(0.01)
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1024)
+        port = sock.getsockname()[1]
+        try:
+            for n in PROCESSES:
+                workers = [
+                    ctx.Process(
+                        target=serve_app, args=(address, sock.fileno())
+                    )
+                    for _ in range(n)
+                ]
+                for w in workers:
+                    w.start()
+                resp = request(
+                    port, "POST", "/login", body="username=a&password=1234"
+                )
+                cookie = resp.getheader("Set-Cookie").split(";")[0]
+                with ctx.Pool(CLIENTS) as pool:
+                    total = sum(
+                        pool.starmap(
+                            client, [(port, cookie, i) for i in range(CLIENTS)]
+                        )
+                    )
+                print(f"processes={n}  {total / SECONDS:8.1f} req/s")
+                for w in workers:
+                    w.terminate()
+                    w.join()
+        finally:
+            storage.terminate()
+            storage.join()
+            sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+# microbenchmark: body render fast path (cached nav fragments) vs chevron
+# run from the repo root: `python -m bench.render`
+import timeit
+
+from pt7.app import ParamsBody, get_body_template, get_body_template_chevron
+
+N = 20_000
+
+
+def params(user):
+    url_user = f"/user/{user}" if user is not None else "/user"
+    return ParamsBody(
+        "user", "/", "/login", "/logout", url_user, "User a", "hi", user
+    )
+
+
+def main():
+    for name, user in (("anonymous", None), ("logged-in", "a")):
+        p = params(user)
+        for label, fn in (
+            ("chevron", get_body_template_chevron),
+            ("fragments", get_body_template),
+        ):
+            t = timeit.timeit(lambda: fn(p), number=N)
+            print(f"{name:10} {label:10} {t / N * 1e6:8.2f} us/render")
+
+
+if __name__ == "__main__":
+    main()
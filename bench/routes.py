@@ -0,0 +1,233 @@
+# every route, in every stage (pt1 .. pt7): req/s and latency percentiles,
+# over a few user counts and inbox sizes. Flask's test client by default;
+# --socket goes through a real (threaded werkzeug) server instead.
+# run from the repo root:
+#   python -m bench.routes run --out bench-routes.json
+#   python -m bench.routes compare bench-baseline.json bench-routes.json
+import argparse
+import http.client
+import importlib
+import json
+import logging
+import statistics
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+STAGES = ("pt1", "pt2", "pt3", "pt4", "pt5", "pt6", "pt7")
+USERS = (2, 10_000)
+INBOX = (1, 1_000)
+REQUESTS = 200
+THRESHOLD = 0.10
+LOGIN = {"username": "a", "password": "1234"}
+
+# name, endpoint, method, path, form, login: None, "once" or "each" (logout
+# ends the session, so it logs back in, untimed, before every request)
+CASES = (
+    ("GET /", "index", "GET", "/", None, None),
+    ("GET /login", "login_get", "GET", "/login", None, None),
+    ("POST /login", "login_post", "POST", "/login", LOGIN, None),
+    ("GET /user/a", "user_msg", "GET", "/user/a", None, "once"),
+    ("GET /logout", "logout", "GET", "/logout", None, "each"),
+)
+
+
+def populate(mod, users, inbox):
+    # users a + b, then filler; "a" gets the inbox, all from "b"
+    names = ["a", "b"] + [f"user{i}" for i in range(users - 2)]
+    if hasattr(mod, "STORAGE_BACKENDS"):  # pt7: storage abstraction
+        sto = mod.StorageMem()
+        sto.add_users(names)
+        sto.set_cred("a", mod.hash_cred("1234"))
+        sto.add_messages_bulk(
+            [("a", mod.Message("b", f"message {i}")) for i in range(inbox)]
+        )
+        mod.app.extensions["storage"] = mod.StorageLocked(sto)
+        # the same login every request: the limiters would 429 it
+        mod.app.extensions["rate_limits"] = {}
+        # entries are tagged by version, and a new store restarts those
+        cache = mod.app.extensions.get("page_cache")
+        if cache is not None:
+            mod.init_page_cache(mod.app, cache.max_bytes)
+    elif hasattr(mod, "users"):  # pt2 .. pt6: module globals
+        mod.users[:] = names
+        mod.creds.clear()
+        mod.creds["a"] = "1234"
+        mod.messages.clear()
+        mod.messages.update({name: [] for name in names})
+        mod.messages["a"] = [
+            {"from": "b", "msg": f"message {i}"} for i in range(inbox)
+        ]
+
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None):
+        return self.client.open(path, method=method, data=form).status_code
+
+    def close(self):
+        pass
+
+
+class SocketClient:
+    def __init__(self, app):
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cookie = None
+
+    def request(self, method, path, form=None):
+        conn = http.client.HTTPConnection("127.0.0.1", self.server.port)
+        headers = {}
+        body = None
+        if form is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            body = "&".join(f"{k}={v}" for k, v in form.items())
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+        set_cookie = resp.getheader("Set-Cookie")
+        if set_cookie is not None:
+            # a deleted cookie comes back empty (and already expired)
+            cookie = set_cookie.split(";")[0]
+            self.cookie = cookie if not cookie.endswith("=") else None
+        return resp.status
+
+    def close(self):
+        self.server.shutdown()
+
+
+def measure(client, method, path, form, login, n):
+    if login == "once":
+        client.request("POST", "/login", LOGIN)
+    times = []
+    for _ in range(n):
+        if login == "each":
+            client.request("POST", "/login", LOGIN)
+        start = time.perf_counter_ns()
+        status = client.request(method, path, form)
+        times.append(time.perf_counter_ns() - start)
+        if status >= 400:
+            raise RuntimeError(f"{method} {path}: {status}")
+    q = statistics.quantiles(times, n=100)
+    return {
+        "rps": n / (sum(times) / 1e9),
+        "p50_us": q[49] / 1e3,
+        "p90_us": q[89] / 1e3,
+        "p99_us": q[98] / 1e3,
+    }
+
+
+def run(args):
+    results = []
+    mode = "socket" if args.socket else "test_client"
+    for stage in args.stages:
+        mod = importlib.import_module(f"{stage}.app")
+        app = mod.app
+        app.secret_key = app.secret_key or "bench"
+        endpoints = {rule.endpoint for rule in app.url_map.iter_rules()}
+        for users in args.users:
+            for inbox in args.inbox:
+                populate(mod, users, inbox)
+                for name, endpoint, method, path, form, login in CASES:
+                    if endpoint not in endpoints:
+                        continue  # this stage doesn't have it yet
+                    if login and "login_post" not in endpoints:
+                        login = None  # nor sessions
+                    client = (
+                        SocketClient(app) if args.socket else TestClient(app)
+                    )
+                    try:
+                        stats = measure(
+                            client, method, path, form, login, args.requests
+                        )
+                    finally:
+                        client.close()
+                    result = {
+                        "stage": stage,
+                        "route": name,
+                        "users": users,
+                        "inbox": inbox,
+                        "mode": mode,
+                        "requests": args.requests,
+                        **stats,
+                    }
+                    results.append(result)
+                    print(
+                        f"{stage} {name:12} users={users:<6} "
+                        f"inbox={inbox:<5} {stats['rps']:9.1f} req/s  "
+                        f"p50 {stats['p50_us']:8.1f}  "
+                        f"p90 {stats['p90_us']:8.1f}  "
+                        f"p99 {stats['p99_us']:8.1f} us"
+                    )
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"results": results}, f, indent=1)
+
+
+def key(result):
+    return (
+        result["stage"],
+        result["route"],
+        result["users"],
+        result["inbox"],
+        result["mode"],
+    )
+
+
+def compare(args):
+    # regression: p50 grew by more than the threshold. Exit 1 if any did
+    with open(args.baseline) as f:
+        baseline = {key(r): r for r in json.load(f)["results"]}
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+    regressions = 0
+    for r in current:
+        base = baseline.get(key(r))
+        if base is None:
+            continue
+        ratio = r["p50_us"] / base["p50_us"]
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        stage, route, users, inbox, mode = key(r)
+        print(
+            f"{stage} {route:12} users={users:<6} inbox={inbox:<5} {mode:11}"
+            f" p50 {base['p50_us']:8.1f} -> {r['p50_us']:8.1f} us"
+            f" ({ratio:5.2f}x){flag}"
+        )
+    print(f"{regressions} regression(s) over {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.routes")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_run = sub.add_parser("run", help="benchmark routes, print (and save)")
+    p_run.add_argument("--stages", nargs="+", default=STAGES)
+    p_run.add_argument("--users", nargs="+", type=int, default=USERS)
+    p_run.add_argument("--inbox", nargs="+", type=int, default=INBOX)
+    p_run.add_argument("--requests", type=int, default=REQUESTS)
+    p_run.add_argument("--socket", action="store_true")
+    p_run.add_argument("--out", help="write results to this JSON file")
+    p_cmp = sub.add_parser("compare", help="current results vs a baseline")
+    p_cmp.add_argument("baseline")
+    p_cmp.add_argument("current")
+    p_cmp.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
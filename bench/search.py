@@ -0,0 +1,124 @@
+# search latency at 1M messages, all in one inbox (the worst case: every
+# posting list is as long as it gets), then the same spread over 3k users
+# searching one small inbox (a backend that ranks every user's hits first
+# shows up there). Words are Zipf-distributed, like text. Indexed
+# StorageMem vs SQLite FTS5 vs a linear scan of the inbox (unranked: newest
+# first, so it stops early on common words)
+# run from the repo root: `python -m bench.search [--messages N]`
+import argparse
+import random
+import statistics
+import tempfile
+import time
+
+from pt7.app import (
+    Message,
+    StorageMem,
+    StorageSQLite,
+    parse_query,
+    tokenize,
+)
+
+VOCAB = 50_000
+WORDS_PER_MESSAGE = 8
+QUERIES = 20
+LIMIT = 20
+
+
+def make_messages(n, users):
+    rng = random.Random(0)
+    words = [f"w{i}x{rng.randrange(10**6)}" for i in range(VOCAB)]
+    weights = [1 / (i + 1) for i in range(VOCAB)]
+    picks = rng.choices(words, weights, k=n * WORDS_PER_MESSAGE)
+    it = iter(picks)
+    return words, [
+        (
+            f"u{i % users}",
+            Message("b", " ".join(next(it) for _ in range(WORDS_PER_MESSAGE))),
+        )
+        for i in range(n)
+    ]
+
+
+def scan(msgs, query, limit):
+    # no index: tokenize every message, keep the ones with every term
+    terms = parse_query(query)
+    out = []
+    for _, msg in reversed(msgs):
+        toks = tokenize(msg.msg)
+        if all(
+            any(t.startswith(tok) if prefix else t == tok for t in toks)
+            for tok, prefix in terms
+        ):
+            out.append(msg)
+            if len(out) == limit:
+                break
+    return out
+
+
+def timed(fn, query):
+    times = []
+    for _ in range(QUERIES):
+        start = time.perf_counter()
+        fn(query)
+        times.append(time.perf_counter() - start)
+    q = statistics.quantiles(times, n=100)
+    return q[49] * 1e3, q[98] * 1e3
+
+
+def run(n, users, no_sqlite):
+    words, msgs = make_messages(n, users)
+    user = "u0"
+    inbox = [(u, msg) for u, msg in msgs if u == user]
+    print(f"{n:,} messages, {users:,} users: searching {len(inbox):,}")
+    queries = {
+        "common": words[0],
+        "mid": words[100],
+        "rare": words[VOCAB - 1],
+        "prefix": words[100][:4] + "*",
+        "two words": f"{words[1]} {words[100]}",
+    }
+    backends = {}
+    start = time.perf_counter()
+    sto = StorageMem()
+    sto.add_messages_bulk(msgs)
+    sto.search_messages(user, words[0], LIMIT)  # mem indexes on first use
+    took = time.perf_counter() - start
+    print(f"mem: loaded {len(msgs):,}, indexed the inbox in {took:.1f} s")
+    backends["mem"] = sto
+    tmp = tempfile.TemporaryDirectory()
+    if not no_sqlite:
+        start = time.perf_counter()
+        sto_sqlite = StorageSQLite(f"{tmp.name}/search.sqlite3")
+        sto_sqlite.add_messages_bulk(msgs)
+        took = time.perf_counter() - start
+        print(f"sqlite fts5: indexed {len(msgs):,} in {took:.1f} s")
+        backends["fts5"] = sto_sqlite
+    for label, query in queries.items():
+        line = f"{label:10} {query!r:24}"
+        for name, sto in backends.items():
+            p50, p99 = timed(
+                lambda q: sto.search_messages(user, q, LIMIT), query
+            )
+            line += f"  {name} p50 {p50:8.2f} p99 {p99:8.2f} ms"
+        start = time.perf_counter()
+        scan(inbox, query, LIMIT)
+        line += f"  scan {(time.perf_counter() - start) * 1e3:8.1f} ms"
+        print(line)
+    if not no_sqlite:
+        sto_sqlite.close()
+    tmp.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.search")
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=3_000)
+    parser.add_argument("--no-sqlite", action="store_true")
+    args = parser.parse_args()
+    run(args.messages, 1, args.no_sqlite)
+    run(args.messages, args.users, args.no_sqlite)
+
+
+if __name__ == "__main__":
+    main()
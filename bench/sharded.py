@@ -0,0 +1,54 @@
+# threaded stress: one StorageMem behind one lock vs StorageSharded, on
+# mixed traffic (9 get_messages : 1 add_message), as thread count grows.
+# NOTE: with the GIL, pure-Python work can't scale past ~1 core; what
+# sharding removes is lock hand-off between threads. Free-threaded builds
+# are where the gap shows. run from the repo root: `python -m bench.sharded`
+import random
+import threading
+import time
+
+from pt7.app import Message, StorageLocked, StorageMem, StorageSharded
+
+USERS = 10_000
+OPS_PER_THREAD = 50_000
+THREADS = (1, 2, 4, 8, 16)
+
+
+def work(sto, users, n, seed):
+    rand = random.Random(seed)
+    msg = Message("a", "hi")
+    for _ in range(n):
+        user = users[rand.randrange(USERS)]
+        if rand.random() < 0.1:
+            sto.add_message(user, msg)
+        else:
+            sto.get_messages(user)
+
+
+def run(sto, users, n_threads):
+    threads = [
+        threading.Thread(target=work, args=(sto, users, OPS_PER_THREAD, i))
+        for i in range(n_threads)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return n_threads * OPS_PER_THREAD / (time.perf_counter() - start)
+
+
+def main():
+    users = [f"user{i}" for i in range(USERS)]
+    for name, make in (
+        ("locked", lambda: StorageLocked(StorageMem())),
+        ("sharded", lambda: StorageSharded(16)),
+    ):
+        for n in THREADS:
+            sto = make()
+            sto.add_users(users)
+            print(f"{name:8} threads={n:<3} {run(sto, users, n):10,.0f} op/s")
+
+
+if __name__ == "__main__":
+    main()
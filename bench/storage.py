@@ -0,0 +1,63 @@
+# throughput: StorageMem (behind the app's lock) vs StorageSQLite, with
+# concurrent reader threads. run from the repo root: `python -m bench.storage`
+import os
+import tempfile
+import threading
+import time
+
+from pt7.app import Message, StorageLocked, StorageMem, StorageSQLite
+
+USERS = 1_000
+MSGS_PER_USER = 10
+OPS_PER_THREAD = 5_000
+THREADS = (1, 2, 4, 8)
+
+
+def fill(sto):
+    users = [f"user{i}" for i in range(USERS)]
+    sto.add_users(users)
+    for user in users:
+        sto.set_cred(user, "1234")
+        for i in range(MSGS_PER_USER):
+            sto.add_message(user, Message("a", f"msg {i}"))
+    return users
+
+
+def read(sto, users, n):
+    # the shape of a /user/<user> hit: check user, cred, fetch inbox
+    for i in range(n):
+        user = users[i % len(users)]
+        sto.get_user(user)
+        sto.get_cred(user)
+        sto.get_messages(user)
+
+
+def run(sto, users, n_threads):
+    threads = [
+        threading.Thread(target=read, args=(sto, users, OPS_PER_THREAD))
+        for _ in range(n_threads)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return n_threads * OPS_PER_THREAD / (time.perf_counter() - start)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = {
+            "mem": StorageLocked(StorageMem()),
+            "sqlite": StorageSQLite(os.path.join(tmp, "bench.sqlite3")),
+        }
+        for name, sto in backends.items():
+            users = fill(sto)
+            for n in THREADS:
+                ops = run(sto, users, n)
+                print(f"{name:7} threads={n}  {ops:10,.0f} op/s")
+        backends["sqlite"].close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# microbenchmark: get_body_params with cached URLs vs url_for every time,
+# for one user (all hits) and for more users than the per-user cache holds
+# run from the repo root: `python -m bench.url_for`
+import timeit
+
+from pt7.app import (
+    URL_CACHE_USERS,
+    app,
+    get_body_params,
+    get_body_params_url_for,
+)
+
+N = 50_000
+
+
+def main():
+    with app.test_request_context("/"):
+        for label, users in (
+            ("1 user", ["a"]),
+            ("2x cache", [f"u{i}" for i in range(URL_CACHE_USERS * 2)]),
+        ):
+            for name, fn in (
+                ("url_for", get_body_params_url_for),
+                ("cached", get_body_params),
+            ):
+                it = iter(range(N))
+                t = timeit.timeit(
+                    lambda: fn("t", "h", "c", users[next(it) % len(users)]),
+                    number=N,
+                )
+                print(f"{label:9} {name:8} {t / N * 1e6:6.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
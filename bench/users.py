@@ -0,0 +1,38 @@
+# scaling benchmark: StorageMem user index, 1e3 .. 1e6 users
+# run from the repo root: `python -m bench.users`
+import time
+import timeit
+
+from pt7.app import StorageMem
+
+SIZES = (1_000, 10_000, 100_000, 1_000_000)
+LOOKUPS = 10_000
+# the old list-backed `in` is O(n); past this it just takes too long to run
+LIST_MAX = 100_000
+
+
+def main():
+    for n in SIZES:
+        users = [f"user{i}" for i in range(n)]
+        sto = StorageMem()
+        start = time.perf_counter()
+        sto.add_users(users)
+        bulk = time.perf_counter() - start
+
+        last = users[-1]
+        hit = timeit.timeit(lambda: sto.get_user(last), number=LOOKUPS)
+        miss = timeit.timeit(lambda: sto.get_user("nope"), number=LOOKUPS)
+        line = (
+            f"n={n:>9,} add_users {bulk * 1e3:8.2f} ms"
+            f"  get_user hit {hit / LOOKUPS * 1e9:6.0f} ns"
+            f"  miss {miss / LOOKUPS * 1e9:6.0f} ns"
+        )
+        if n <= LIST_MAX:
+            as_list = list(users)
+            old = timeit.timeit(lambda: last in as_list, number=100)
+            line += f"  (list: {old / 100 * 1e9:10.0f} ns)"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
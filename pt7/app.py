@@ -3,11 +3,45 @@ import typing as T
 import dataclasses
 from dataclasses import dataclass
 import abc
-
-import pytest  # WARN: normally do not do this in prod code
+import threading
+import time
+import functools
+import hashlib
+import collections
+import hmac
+import concurrent.futures
+import contextlib
+import queue
+import json
+import secrets
+import mmap
+import struct
+import zlib
+from array import array
+import bisect
+import re
+import math
+import heapq
+import itertools
+import inspect
+import weakref
+import contextvars
+
+import click
 import flask
+import flask.sessions
+import werkzeug.datastructures
+import werkzeug.routing
 import markupsafe
 import chevron
+import chevron.tokenizer
+
+# imported where they're first used instead, so boot doesn't pay for them:
+# asyncio (async views), sqlite3 (sqlite backends), multiprocessing.managers
+# (remote storage). Worker startup: `make importtime`
+if T.TYPE_CHECKING:
+    import sqlite3
+    import multiprocessing.managers
 
 # pt1: add app, serve index
 # pt2: add "messaging" and "user"
@@ -17,18 +51,175 @@ import chevron
 # pt6: add testing NOTE: always at bottom. New code below others, above test
 # pt7: add storage abstraction
 
-app = flask.Flask(__name__)
-app.secret_key = os.environ.get("FLASK_SECRET_KEY")
+
+# a url_map that counts rule changes, so cached URLs (get_body_params) can
+# tell when they went stale. Has to be the class Flask builds the map from
+class UrlMap(werkzeug.routing.Map):
+    version = 0
+
+    def add(self, rulefactory: werkzeug.routing.RuleFactory) -> None:
+        super().add(rulefactory)
+        self.version += 1
+
+
+class App(flask.Flask):
+    url_map_class = UrlMap
+
+
+# No app at import time (see create_app, at the bottom). Routes and CLI
+# commands are collected as the module defines them, then added to each app
+ROUTES: list[tuple[str, T.Callable, dict[str, T.Any]]] = []
+COMMANDS: list[click.Command] = []
+
+
+def route(rule: str, **options: T.Any) -> T.Callable[[T.Callable], T.Callable]:
+    def decorator(view: T.Callable) -> T.Callable:
+        ROUTES.append((rule, view, options))
+        return view
+
+    return decorator
+
+
+def command(name: str) -> T.Callable[[T.Callable], click.Command]:
+    def decorator(fn: T.Callable) -> click.Command:
+        cmd = click.command(name)(flask.cli.with_appcontext(fn))
+        COMMANDS.append(cmd)
+        return cmd
+
+    return decorator
 
 
 def get_storage_flask():
-    # Not my favorite pattern, but from Flask docs,
-    # and lifecycle hooks are deprecated
-    if "storage" not in flask.g:
-        sto = StorageMem()
-        seed(sto)
-        flask.g.storage = sto
-    return flask.g.storage
+    # NOTE: was on `flask.g`, which only lives for one request - so every hit
+    # rebuilt + re-seeded storage and dropped any writes. Now lives on the app
+    return flask.current_app.extensions["storage"]
+
+
+# metrics: latency histograms per route and per span (storage calls,
+# rendering, url_for). Opt in with METRICS=1; when off, `timed` hands the
+# function back untouched and nothing is wrapped, so it costs nothing
+
+# upper bounds in seconds, like Prometheus `le`; spans are often µs
+METRICS_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = METRICS_BUCKETS) -> None:
+        self.buckets = buckets
+        self.bounds_ns = [round(b * 1e9) for b in buckets]
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum_ns = 0
+        self.lock = threading.Lock()
+
+    def observe(self, ns: int) -> None:
+        i = bisect.bisect_left(self.bounds_ns, ns)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum_ns += ns
+
+    def snapshot(self) -> tuple[list[int], int]:
+        with self.lock:
+            return list(self.counts), self.sum_ns
+
+
+# Per-request span totals, for the Server-Timing header. A contextvar, not
+# a thread local, so async views (run in another thread) still add to it
+SPANS: contextvars.ContextVar[T.Optional[dict[str, int]]] = (
+    contextvars.ContextVar("spans", default=None)
+)
+
+
+class Metrics:
+    def __init__(self) -> None:
+        # (kind, name) -> Histogram; kind is "request" (by route) or "span"
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, kind: str, name: str) -> Histogram:
+        key = (kind, name)
+        hist = self.histograms.get(key)
+        if hist is None:
+            with self.lock:
+                hist = self.histograms.setdefault(key, Histogram())
+        return hist
+
+    def timed(self, name: str, fn: T.Callable) -> T.Callable:
+        # histogram looked up once here, not per call
+        hist = self.histogram("span", name)
+        perf_counter_ns = time.perf_counter_ns
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                ns = perf_counter_ns() - start
+                hist.observe(ns)
+                spans = SPANS.get()
+                if spans is not None:
+                    spans[name] = spans.get(name, 0) + ns
+
+        return wrapper
+
+    def render(self) -> str:
+        # Prometheus text format: cumulative buckets, then _sum and _count
+        lines = []
+        with self.lock:  # histogram() may add a key mid-scrape
+            items = sorted(self.histograms.items())
+        for kind, label in (("request", "route"), ("span", "span")):
+            metric = f"pt7_{kind}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for (k, name), hist in items:
+                if k != kind:
+                    continue
+                counts, sum_ns = hist.snapshot()
+                name = name.replace("\\", "\\\\").replace('"', '\\"')
+                total = 0
+                les = [repr(b) for b in hist.buckets] + ["+Inf"]
+                for le, count in zip(les, counts):
+                    total += count
+                    lines.append(
+                        f'{metric}_bucket{{{label}="{name}",le="{le}"}} '
+                        f"{total}"
+                    )
+                lines.append(
+                    f'{metric}_sum{{{label}="{name}"}} {sum_ns / 1e9}'
+                )
+                lines.append(f'{metric}_count{{{label}="{name}"}} {total}')
+        return "\n".join(lines) + "\n"
+
+
+METRICS: T.Optional[Metrics] = Metrics() if os.environ.get("METRICS") else None
+
+
+def timed(name: str) -> T.Callable[[T.Callable], T.Callable]:
+    def decorator(fn: T.Callable) -> T.Callable:
+        if METRICS is None:
+            return fn
+        return METRICS.timed(name, fn)
+
+    return decorator
 
 
 # "messaging" with storage
@@ -40,6 +231,14 @@ class Message:
     msg: str
 
 
+# A cursor is opaque to callers: pass back next/prev from the last page
+@dataclass(frozen=True)
+class MessagePage:
+    messages: list[Message]
+    next_cursor: T.Optional[int]
+    prev_cursor: T.Optional[int]
+
+
 # "Abstract base class"; not really OOP. Typeclassing - this is "interface"
 # Avoid hierarchic implementation details. `super` is your sign. Use if needed
 class Storage(abc.ABC):
@@ -51,6 +250,14 @@ class Storage(abc.ABC):
     def add_user(self, user: str) -> None:
         pass
 
+    @abc.abstractmethod
+    def add_users(self, users: T.Iterable[str]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def list_users(self) -> list[str]:
+        pass
+
     @abc.abstractmethod
     def get_cred(self, user: str) -> T.Optional[str]:
         pass
@@ -63,18 +270,253 @@ class Storage(abc.ABC):
     def get_messages(self, user: str) -> T.Optional[list[Message]]:
         pass
 
+    @abc.abstractmethod
+    def get_messages_page(
+        self, user: str, cursor: T.Optional[int], limit: int
+    ) -> MessagePage:
+        pass
+
     @abc.abstractmethod
     def add_message(self, user: str, msg: Message) -> None:
         pass
 
+    @abc.abstractmethod
+    def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        pass
+
+    # bumped by add_message/set_cred; lets callers know a page is still fresh
+    @abc.abstractmethod
+    def get_version(self, user: str) -> int:
+        pass
+
+    # best match first; see parse_query for the query syntax
+    @abc.abstractmethod
+    def search_messages(
+        self, user: str, query: str, limit: int
+    ) -> list[Message]:
+        pass
+
+
+# How StorageMem holds messages. The plain one: a list of Message per user
+class MessagesList:
+    def __init__(self) -> None:
+        self.by_user: dict[str, list[Message]] = {}
+
+    def get(self, user: str) -> T.Optional[list[Message]]:
+        return self.by_user.get(user)
+
+    def slice(
+        self, user: str, start: int, end: int
+    ) -> tuple[list[Message], int]:
+        msgs = self.by_user.get(user, [])
+        return msgs[start:end], len(msgs)
+
+    def pick(self, user: str, positions: list[int]) -> list[Message]:
+        msgs = self.by_user[user]
+        return [msgs[i] for i in positions]
+
+    def add(self, user: str, msg: Message) -> None:
+        # NOTE: mutation for the in-memory case, but generally "add to list"
+        msgs = self.by_user.get(user)
+        if msgs is None:
+            msgs = []
+            self.by_user[user] = msgs
+        msgs.append(msg)
+
+
+# The compact one, for millions of messages: no per-message objects. Bodies
+# are appended to one UTF-8 buffer, senders interned to ints, and each user
+# has an array of message numbers. Message objects get built on read only
+class MessagesCompact:
+    def __init__(self) -> None:
+        self.body = bytearray()
+        self.starts = array("Q")  # message number -> offset into body
+        self.frms = array("I")  # message number -> interned sender
+        self.frm_ids: dict[str, int] = {}
+        self.frm_names: list[str] = []
+        self.by_user: dict[str, array] = {}
+
+    def materialize(self, i: int) -> Message:
+        start = self.starts[i]
+        end = self.starts[i + 1] if i + 1 < len(self.starts) else None
+        body = self.body[start:end].decode()
+        return Message(self.frm_names[self.frms[i]], body)
+
+    def get(self, user: str) -> T.Optional[list[Message]]:
+        nums = self.by_user.get(user)
+        if nums is None:
+            return None
+        return [self.materialize(i) for i in nums]
+
+    def slice(
+        self, user: str, start: int, end: int
+    ) -> tuple[list[Message], int]:
+        nums = self.by_user.get(user)
+        if nums is None:
+            return [], 0
+        return [self.materialize(i) for i in nums[start:end]], len(nums)
+
+    def pick(self, user: str, positions: list[int]) -> list[Message]:
+        nums = self.by_user[user]
+        return [self.materialize(nums[i]) for i in positions]
+
+    def add(self, user: str, msg: Message) -> None:
+        frm = self.frm_ids.get(msg.frm)
+        if frm is None:
+            frm = self.frm_ids[msg.frm] = len(self.frm_names)
+            self.frm_names.append(msg.frm)
+        nums = self.by_user.get(user)
+        if nums is None:
+            nums = self.by_user[user] = array("Q")
+        nums.append(len(self.starts))
+        self.starts.append(len(self.body))
+        self.frms.append(frm)
+        self.body += msg.msg.encode()
+
+
+# search: an inverted index, token -> the positions (in the user's message
+# list) of the messages it occurs in, once per occurrence. Updated as
+# messages are added, so a query never scans an inbox. Queries are words,
+# all of which must match (AND); `word*` matches any token it prefixes
+
+SEARCH_TOKEN = re.compile(r"\w+")
+SEARCH_QUERY = re.compile(r"(\w+)(\*?)")
+SEARCH_TERMS_MAX = 8
+SEARCH_PREFIX_MAX = 1000  # tokens a prefix can expand to
+SEARCH_K1 = 1.2
+# candidates x lists x this < a term's postings: bisect, don't count
+SEARCH_BISECT_RATIO = 16
+
+
+def tokenize(text: str) -> list[str]:
+    return SEARCH_TOKEN.findall(text.lower())
+
+
+def parse_query(query: str) -> list[tuple[str, bool]]:
+    # (token, is_prefix)
+    terms = SEARCH_QUERY.findall(query.lower())[:SEARCH_TERMS_MAX]
+    return [(tok, star == "*") for tok, star in terms]
+
+
+class SearchIndex:
+    def __init__(self) -> None:
+        self.postings: dict[str, dict[str, array]] = {}
+        self.counts: dict[str, int] = {}  # messages indexed, per user
+        # per user: their tokens, sorted, for prefix lookups (bisect). New
+        # tokens wait in `unsorted` until a prefix query needs the vocab
+        self.vocab: dict[str, list[str]] = {}
+        self.unsorted: dict[str, list[str]] = {}
+
+    def add(self, user: str, msg: Message) -> None:
+        # position: messages are indexed in the order storage appends them
+        pos = self.counts.get(user, 0)
+        self.counts[user] = pos + 1
+        postings = self.postings.get(user)
+        if postings is None:
+            postings = self.postings[user] = {}
+        for tok in tokenize(msg.msg):
+            positions = postings.get(tok)
+            if positions is None:
+                positions = postings[tok] = array("L")
+                self.unsorted.setdefault(user, []).append(tok)
+            positions.append(pos)
+
+    def add_all(self, user: str, msgs: T.Iterable[Message]) -> None:
+        # a user's whole inbox, oldest first; after this `user in counts`
+        self.counts.setdefault(user, 0)
+        for msg in msgs:
+            self.add(user, msg)
+
+    def expand(self, user: str, prefix: str) -> list[str]:
+        vocab = self.vocab.setdefault(user, [])
+        new = self.unsorted.pop(user, None)
+        if new:
+            # a sorted run plus a short tail: timsort merges, doesn't resort
+            vocab += new
+            vocab.sort()
+        i = bisect.bisect_left(vocab, prefix)
+        out = []
+        for tok in itertools.islice(vocab, i, i + SEARCH_PREFIX_MAX):
+            if not tok.startswith(prefix):
+                break
+            out.append(tok)
+        return out
+
+    def search(
+        self, user: str, terms: list[tuple[str, bool]], limit: int
+    ) -> list[int]:
+        # BM25 without length normalisation; ties go to the newest message.
+        # df is counted in occurrences (what the posting lists hold)
+        postings = self.postings.get(user)
+        if not postings or not terms:
+            return []
+        n = self.counts[user]
+        matched = []
+        for tok, prefix in terms:
+            lists = [
+                postings[t]
+                for t in (self.expand(user, tok) if prefix else (tok,))
+                if t in postings
+            ]
+            if not lists:
+                return []
+            matched.append((sum(map(len, lists)), lists))
+        # rarest first: the rest only need checking against its matches
+        matched.sort(key=lambda m: m[0])
+        k1 = SEARCH_K1
+        scores: dict[int, float] = {}
+        for no, (df, lists) in enumerate(matched):
+            bisect_cost = len(scores) * len(lists) * SEARCH_BISECT_RATIO
+            tf: collections.Counter[int] = collections.Counter()
+            if no == 0 or bisect_cost > df:
+                # count every occurrence (in C)
+                for positions in lists:
+                    tf.update(positions)
+            else:
+                # few candidates, long lists: positions are sorted, so
+                # look each candidate up instead of walking the lists
+                for i in scores:
+                    for positions in lists:
+                        c = bisect.bisect_right(positions, i) - (
+                            bisect.bisect_left(positions, i)
+                        )
+                        if c:
+                            tf[i] += c
+            if len(matched) == 1:
+                # one term: the score only grows with tf, so rank by that
+                top = heapq.nlargest(
+                    limit, tf.items(), key=lambda kv: (kv[1], kv[0])
+                )
+                return [i for i, _ in top]
+            df = min(df, n)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            # a message's weight only depends on its tf; there are few tfs
+            w = {c: idf * c * (k1 + 1) / (c + k1) for c in set(tf.values())}
+            if no == 0:
+                scores = {i: w[c] for i, c in tf.items()}
+            else:
+                scores = {
+                    i: s + w[tf[i]] for i, s in scores.items() if i in tf
+                }
+            if not scores:
+                return []
+        return heapq.nlargest(limit, scores, key=lambda i: (scores[i], i))
+
 
 # not really OOP, impl of iface, in a land with no interfaces or typeclass...
 # (although kind of a weird conversation; in the ways used here, equivalent)
 class StorageMem:
-    def __init__(self) -> None:
-        self.users: list[str] = []
+    def __init__(self, compact: bool = False) -> None:
+        # dict as an insertion-ordered set: O(1) `in`, keeps listing order
+        self.users: dict[str, None] = {}
         self.creds: dict[str, str] = {}
-        self.messages: dict[str, list[Message]] = {}
+        self.messages: T.Union[MessagesList, MessagesCompact] = (
+            MessagesCompact() if compact else MessagesList()
+        )
+        self.versions: dict[str, int] = {}
+        # built per user by their first search, then kept up to date by
+        # add_message: inboxes nobody searches don't pay for an index
+        self.search = SearchIndex()
 
     def get_user(self, user: str) -> bool:
         if user in self.users:
@@ -82,9 +524,15 @@ class StorageMem:
         return False
 
     def add_user(self, user: str) -> None:
-        if user in self.users:
-            return
-        self.users.append(user)
+        # setdefault: no-op for an existing user, and it keeps its position
+        self.users.setdefault(user, None)
+
+    def add_users(self, users: T.Iterable[str]) -> None:
+        # one pass, in C; dupes (in `users` or already present) are no-ops
+        self.users.update(dict.fromkeys(users))
+
+    def list_users(self) -> list[str]:
+        return list(self.users)
 
     def get_cred(self, user: str) -> T.Optional[str]:
         return self.creds.get(user)
@@ -94,17 +542,47 @@ class StorageMem:
             raise ValueError("Can't add a cred for a non-existant user")
         # TODO: fabulous place for (external) cred complexity validation
         self.creds[user] = cred
+        self.versions[user] = self.versions.get(user, 0) + 1
 
     def get_messages(self, user: str) -> T.Optional[list[Message]]:
         return self.messages.get(user)
 
+    def get_messages_page(
+        self, user: str, cursor: T.Optional[int], limit: int
+    ) -> MessagePage:
+        # cursor is the list index; messages are append-only so it's stable
+        start = cursor or 0
+        end = start + limit
+        msgs, total = self.messages.slice(user, start, end)
+        return MessagePage(
+            msgs,
+            end if end < total else None,
+            max(start - limit, 0) if start > 0 else None,
+        )
+
     def add_message(self, user: str, msg: Message) -> None:
-        # NOTE: mutation for the in-memory case, but generally "add to list"
-        msgs = self.messages.get(user)
-        if msgs is None:
-            msgs = []
-            self.messages[user] = msgs
-        msgs.append(msg)
+        self.messages.add(user, msg)
+        if user in self.search.counts:
+            self.search.add(user, msg)
+        self.versions[user] = self.versions.get(user, 0) + 1
+
+    def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        for user, msg in msgs:
+            self.add_message(user, msg)
+
+    def get_version(self, user: str) -> int:
+        return self.versions.get(user, 0)
+
+    def search_messages(
+        self, user: str, query: str, limit: int
+    ) -> list[Message]:
+        if user not in self.search.counts:
+            msgs = self.messages.get(user)
+            if not msgs:
+                return []
+            self.search.add_all(user, msgs)
+        positions = self.search.search(user, parse_query(query), limit)
+        return self.messages.pick(user, positions) if positions else []
 
 
 # Yes; it is really not inheritance.
@@ -117,8 +595,8 @@ def seed_users(sto: Storage):
 
 
 def seed_creds(sto: Storage):
-    sto.set_cred("a", "1234")
-    sto.set_cred("b", "1234")
+    sto.set_cred("a", hash_cred("1234"))
+    sto.set_cred("b", hash_cred("1234"))
 
 
 def seed_messages(sto: Storage):
@@ -131,24 +609,1136 @@ def seed_messages(sto: Storage):
     )
 
 
+@timed("seed")
 def seed(sto: Storage):
     seed_users(sto)
     seed_creds(sto)
     seed_messages(sto)
 
 
+# Shared by every request (and thread) for the life of the app, so guard it.
+# One big lock is the dumb, correct version; fine for StorageMem-sized work
+class StorageLocked:
+    def __init__(self, sto: Storage) -> None:
+        self.sto = sto
+        self.lock = threading.RLock()
+
+    def get_user(self, user: str) -> bool:
+        with self.lock:
+            return self.sto.get_user(user)
+
+    def add_user(self, user: str) -> None:
+        with self.lock:
+            self.sto.add_user(user)
+
+    def add_users(self, users: T.Iterable[str]) -> None:
+        users = list(users)  # don't run a caller's generator under the lock
+        with self.lock:
+            self.sto.add_users(users)
+
+    def list_users(self) -> list[str]:
+        with self.lock:
+            return self.sto.list_users()
+
+    def get_cred(self, user: str) -> T.Optional[str]:
+        with self.lock:
+            return self.sto.get_cred(user)
+
+    def set_cred(self, user: str, cred: str) -> None:
+        with self.lock:
+            self.sto.set_cred(user, cred)
+
+    def get_messages(self, user: str) -> T.Optional[list[Message]]:
+        with self.lock:
+            msgs = self.sto.get_messages(user)
+            # copy, so callers don't iterate while another thread appends
+            return list(msgs) if msgs is not None else None
+
+    def get_messages_page(
+        self, user: str, cursor: T.Optional[int], limit: int
+    ) -> MessagePage:
+        with self.lock:
+            return self.sto.get_messages_page(user, cursor, limit)
+
+    def add_message(self, user: str, msg: Message) -> None:
+        with self.lock:
+            self.sto.add_message(user, msg)
+
+    def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        # one lock round trip for the whole batch
+        with self.lock:
+            self.sto.add_messages_bulk(msgs)
+
+    def get_version(self, user: str) -> int:
+        with self.lock:
+            return self.sto.get_version(user)
+
+    def search_messages(
+        self, user: str, query: str, limit: int
+    ) -> list[Message]:
+        with self.lock:
+            return self.sto.search_messages(user, query, limit)
+
+
+Storage.register(StorageLocked)
+
+
+# N StorageMem shards, each behind its own lock; a user lives in exactly one
+# (by hash), so requests for different users rarely wait on each other.
+# Only adding/listing users touches the global order, under its own lock
+class StorageSharded:
+    threadsafe = True
+
+    def __init__(self, shards: int = 16, compact: bool = False) -> None:
+        self.shards = [
+            StorageLocked(StorageMem(compact)) for _ in range(shards)
+        ]
+        self.order: dict[str, None] = {}
+        self.order_lock = threading.Lock()
+
+    def shard(self, user: str) -> StorageLocked:
+        # in-process only, so the (per-run salted) str hash is fine
+        return self.shards[hash(user) % len(self.shards)]
+
+    def get_user(self, user: str) -> bool:
+        return self.shard(user).get_user(user)
+
+    def add_user(self, user: str) -> None:
+        self.add_users([user])
+
+    def add_users(self, users: T.Iterable[str]) -> None:
+        users = list(users)
+        by_shard: dict[int, list[str]] = {}
+        for user in users:
+            by_shard.setdefault(hash(user) % len(self.shards), []).append(user)
+        # into the order first: a user visible in a shard is always listed
+        with self.order_lock:
+            self.order.update(dict.fromkeys(users))
+        for no, shard_users in by_shard.items():
+            self.shards[no].add_users(shard_users)
+
+    def list_users(self) -> list[str]:
+        with self.order_lock:
+            return list(self.order)
+
+    def get_cred(self, user: str) -> T.Optional[str]:
+        return self.shard(user).get_cred(user)
+
+    def set_cred(self, user: str, cred: str) -> None:
+        self.shard(user).set_cred(user, cred)
+
+    def get_messages(self, user: str) -> T.Optional[list[Message]]:
+        return self.shard(user).get_messages(user)
+
+    def get_messages_page(
+        self, user: str, cursor: T.Optional[int], limit: int
+    ) -> MessagePage:
+        return self.shard(user).get_messages_page(user, cursor, limit)
+
+    def add_message(self, user: str, msg: Message) -> None:
+        self.shard(user).add_message(user, msg)
+
+    def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        by_shard: dict[int, list[tuple[str, Message]]] = {}
+        for user, msg in msgs:
+            no = hash(user) % len(self.shards)
+            by_shard.setdefault(no, []).append((user, msg))
+        for no, shard_msgs in by_shard.items():
+            self.shards[no].add_messages_bulk(shard_msgs)
+
+    def get_version(self, user: str) -> int:
+        return self.shard(user).get_version(user)
+
+    def search_messages(
+        self, user: str, query: str, limit: int
+    ) -> list[Message]:
+        return self.shard(user).search_messages(user, query, limit)
+
+
+Storage.register(StorageSharded)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS creds (
+    user TEXT PRIMARY KEY,
+    cred TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    frm TEXT NOT NULL,
+    msg TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_user_id ON messages (user, id);
+CREATE TABLE IF NOT EXISTS versions (
+    user TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS messages_version AFTER INSERT ON messages
+BEGIN
+    INSERT INTO versions (user, version) VALUES (NEW.user, 1)
+    ON CONFLICT (user) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS creds_version_insert AFTER INSERT ON creds
+BEGIN
+    INSERT INTO versions (user, version) VALUES (NEW.user, 1)
+    ON CONFLICT (user) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS creds_version_update AFTER UPDATE ON creds
+BEGIN
+    UPDATE versions SET version = version + 1 WHERE user = NEW.user;
+END;
+-- search: FTS5 over messages, kept up to date by a trigger. Contentless
+-- (rows are read back from messages by rowid), tokenized like `tokenize`.
+-- owner is the user as one token, 'u' || hex(name): any name survives the
+-- tokenizer, and the MATCH only ranks the owner's rows
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_search USING fts5(
+    owner,
+    msg,
+    content = '',
+    tokenize = "unicode61 remove_diacritics 0 tokenchars '_'"
+);
+CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO messages_search (rowid, owner, msg)
+    VALUES (NEW.id, 'u' || hex(NEW.user), NEW.msg);
+END;
+-- the index from before search was per user, if any
+DROP TRIGGER IF EXISTS messages_fts_insert;
+DROP TABLE IF EXISTS messages_fts;
+"""
+
+# Constant SQL strings on purpose: sqlite3 keeps a per-connection cache of
+# prepared statements keyed by the SQL text, so these get compiled once
+SQL_GET_USER = "SELECT 1 FROM users WHERE name = ?"
+SQL_ADD_USER = "INSERT OR IGNORE INTO users (name) VALUES (?)"
+SQL_LIST_USERS = "SELECT name FROM users ORDER BY id"
+SQL_GET_CRED = "SELECT cred FROM creds WHERE user = ?"
+SQL_SET_CRED = (
+    "INSERT INTO creds (user, cred) VALUES (?, ?)"
+    " ON CONFLICT (user) DO UPDATE SET cred = excluded.cred"
+)
+SQL_GET_MESSAGES = "SELECT frm, msg FROM messages WHERE user = ? ORDER BY id"
+# keyset paging: cursor is a message id, so no OFFSET scans
+SQL_GET_MESSAGES_PAGE = (
+    "SELECT id, frm, msg FROM messages WHERE user = ? AND id >= ?"
+    " ORDER BY id LIMIT ?"
+)
+SQL_GET_MESSAGES_PREV = (
+    "SELECT min(id) FROM (SELECT id FROM messages WHERE user = ? AND id < ?"
+    " ORDER BY id DESC LIMIT ?)"
+)
+# versions are bumped by triggers, in the same statement as the write
+SQL_GET_VERSION = "SELECT version FROM versions WHERE user = ?"
+SQL_ADD_MESSAGE = "INSERT INTO messages (user, frm, msg) VALUES (?, ?, ?)"
+SQL_HAS_FTS = "SELECT 1 FROM sqlite_master WHERE name = 'messages_search'"
+SQL_FTS_FILL = (
+    "INSERT INTO messages_search (rowid, owner, msg)"
+    " SELECT id, 'u' || hex(user), msg FROM messages"
+)
+# the owner term scopes the MATCH, so bm25 (rank) only scores the user's
+# hits; it adds the same to each, so the order is msg's alone
+SQL_SEARCH_MESSAGES = (
+    "SELECT m.frm, m.msg FROM messages_search"
+    " JOIN messages m ON m.id = messages_search.rowid"
+    " WHERE messages_search MATCH ? ORDER BY rank LIMIT ?"
+)
+
+
+def fts_quote(s: str) -> str:
+    return '"' + s.replace('"', '""') + '"'
+
+
+# hex() in SQLite is of the UTF-8 bytes, upper case
+def get_fts_owner(user: str) -> str:
+    return "u" + user.encode().hex().upper()
+
+
+def get_fts_query(user: str, terms: list[tuple[str, bool]]) -> str:
+    return " AND ".join(
+        [f"owner : {get_fts_owner(user)}"]
+        + [
+            f"msg : {fts_quote(tok)}" + (" *" if prefix else "")
+            for tok, prefix in terms
+        ]
+    )
+
+
+# A plain os.fork() (gunicorn --preload) copies open connections into the
+# child, where they can't be used. Objects holding any add themselves here,
+# and get after_fork() called in the child, before it runs anything else
+AFTER_FORK: "weakref.WeakSet[T.Any]" = weakref.WeakSet()
+
+
+def reset_after_fork() -> None:
+    for obj in list(AFTER_FORK):
+        obj.after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+SQLITE_POOL_SIZE = 8
+
+
+# A connection can't be used by two threads at once, so each call checks one
+# out and hands it back. At most `size` are open; more callers wait. LIFO:
+# the most recently used (warmest statement cache) goes out first
+class SQLitePool:
+    def __init__(self, path: str, size: int = SQLITE_POOL_SIZE) -> None:
+        self.path = path
+        self.size = size
+        self.idle: queue.LifoQueue["sqlite3.Connection"] = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.opened = 0
+        # the parent's connections, in a forked child: see after_fork
+        self.abandoned: list["sqlite3.Connection"] = []
+        AFTER_FORK.add(self)
+
+    def connect(self) -> "sqlite3.Connection":
+        # autocommit; bulk writes open their own transaction.
+        # check_same_thread off: connections move between threads
+        import sqlite3
+
+        conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        self.opened += 1
+        return conn
+
+    @contextlib.contextmanager
+    def conn(self) -> T.Iterator["sqlite3.Connection"]:
+        # NOTE: don't nest; a thread holding one and waiting on another
+        # can starve the pool
+        with self.slots:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            try:
+                yield conn
+            finally:
+                self.idle.put(conn)
+
+    def close(self) -> None:
+        # closes the idle ones; call once nothing is checked out
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def after_fork(self) -> None:
+        # SQLite: never use a connection across a fork, nor close it (that
+        # can drop the parent's locks). So keep them, unused, and start over.
+        # Fresh queue + semaphore: another thread may have held theirs
+        self.abandoned.extend(self.idle.queue)
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.size)
+
+
+# SQLite does its own locking; WAL lets readers run alongside one writer
+class StorageSQLite:
+    threadsafe = True
+
+    def __init__(self, path: str) -> None:
+        self.pool = SQLitePool(path)
+        with self.pool.conn() as conn:
+            has_fts = conn.execute(SQL_HAS_FTS).fetchone() is not None
+            conn.executescript(SQLITE_SCHEMA)
+            if not has_fts:
+                # a db from before (per-user) search: index what's there
+                conn.execute(SQL_FTS_FILL)
+
+    def conn(self) -> T.ContextManager["sqlite3.Connection"]:
+        return self.pool.conn()
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def get_user(self, user: str) -> bool:
+        with self.conn() as conn:
+            row = conn.execute(SQL_GET_USER, (user,)).fetchone()
+        return row is not None
+
+    def add_user(self, user: str) -> None:
+        with self.conn() as conn:
+            conn.execute(SQL_ADD_USER, (user,))
+
+    def add_users(self, users: T.Iterable[str]) -> None:
+        users = list(users)  # not a caller's generator, with a conn held
+        with self.conn() as conn, conn:
+            conn.execute("BEGIN")
+            conn.executemany(SQL_ADD_USER, ((u,) for u in users))
+
+    def list_users(self) -> list[str]:
+        with self.conn() as conn:
+            rows = conn.execute(SQL_LIST_USERS).fetchall()
+        return [name for (name,) in rows]
+
+    def get_cred(self, user: str) -> T.Optional[str]:
+        with self.conn() as conn:
+            row = conn.execute(SQL_GET_CRED, (user,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_cred(self, user: str, cred: str) -> None:
+        if not self.get_user(user):
+            raise ValueError("Can't add a cred for a non-existant user")
+        with self.conn() as conn:
+            conn.execute(SQL_SET_CRED, (user, cred))
+
+    def get_messages(self, user: str) -> T.Optional[list[Message]]:
+        with self.conn() as conn:
+            rows = conn.execute(SQL_GET_MESSAGES, (user,)).fetchall()
+        # same contract as StorageMem: None when there's nothing there
+        if not rows:
+            return None
+        return [Message(frm, msg) for frm, msg in rows]
+
+    def get_messages_page(
+        self, user: str, cursor: T.Optional[int], limit: int
+    ) -> MessagePage:
+        start = cursor or 0
+        with self.conn() as conn:
+            # one extra row tells us whether there's a next page, and where
+            rows = conn.execute(
+                SQL_GET_MESSAGES_PAGE, (user, start, limit + 1)
+            ).fetchall()
+            (prev_cursor,) = conn.execute(
+                SQL_GET_MESSAGES_PREV, (user, start, limit)
+            ).fetchone()
+        next_cursor = rows[limit][0] if len(rows) > limit else None
+        return MessagePage(
+            [Message(frm, msg) for _, frm, msg in rows[:limit]],
+            next_cursor,
+            prev_cursor,
+        )
+
+    def add_message(self, user: str, msg: Message) -> None:
+        with self.conn() as conn:
+            conn.execute(SQL_ADD_MESSAGE, (user, msg.frm, msg.msg))
+
+    def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        # one transaction (and one WAL sync) per batch instead of per row
+        with self.conn() as conn, conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                SQL_ADD_MESSAGE,
+                ((user, msg.frm, msg.msg) for user, msg in msgs),
+            )
+
+    def get_version(self, user: str) -> int:
+        with self.conn() as conn:
+            row = conn.execute(SQL_GET_VERSION, (user,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def search_messages(
+        self, user: str, query: str, limit: int
+    ) -> list[Message]:
+        terms = parse_query(query)
+        if not terms:
+            return []
+        with self.conn() as conn:
+            rows = conn.execute(
+                SQL_SEARCH_MESSAGES, (get_fts_query(user, terms), limit)
+            ).fetchall()
+        return [Message(frm, msg) for frm, msg in rows]
+
+
+Storage.register(StorageSQLite)
+
+# append-only logs: every record is (payload length, kind) + payload.
+# users/creds go to meta.log (so listing order survives a restart), each
+# message to messages-<n>.log for its user's shard
+LOG_HEADER = struct.Struct("<IB")
+LOG_MESSAGE = struct.Struct("<HH")  # user, frm byte lengths; msg is the rest
+LOG_CRED = struct.Struct("<H")  # user byte length; cred is the rest
+LOG_KIND_USER = 1
+LOG_KIND_CRED = 2
+LOG_KIND_MESSAGE = 3
+
+
+def log_record(kind: int, payload: bytes) -> bytes:
+    return LOG_HEADER.pack(len(payload), kind) + payload
+
+
+def log_message_record(user: str, msg: Message) -> bytes:
+    u, f, m = user.encode(), msg.frm.encode(), msg.msg.encode()
+    return log_record(
+        LOG_KIND_MESSAGE, LOG_MESSAGE.pack(len(u), len(f)) + u + f + m
+    )
+
+
+class LogFile:
+    def __init__(self, path: str) -> None:
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.written = os.fstat(self.fd).st_size
+        self.synced = self.written
+        # writers take `lock`; `synced_cond` is for waiting on an fsync
+        self.lock = threading.Lock()
+        self.synced_cond = threading.Condition()
+        self.mm: T.Optional[mmap.mmap] = None
+        self.mv = memoryview(b"")
+
+    def append(self, data: bytes) -> tuple[int, int]:
+        # caller holds self.lock. -> (start, end) offsets of what was written
+        start = self.written
+        view = memoryview(data)
+        while view:
+            n = os.write(self.fd, view)
+            view = view[n:]
+        self.written += len(data)
+        return start, self.written
+
+    def view(self, end: int) -> memoryview:
+        # (re)map once readers need bytes past the current mapping. Old maps
+        # aren't closed: slices handed out earlier may still point into them
+        if len(self.mv) < end:
+            with self.lock:
+                return self.view_locked(end)
+        return self.mv
+
+    def view_locked(self, end: int) -> memoryview:
+        # same, for callers already holding self.lock
+        if len(self.mv) < end:
+            self.mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            self.mv = memoryview(self.mm)
+        return self.mv
+
+    def sync(self) -> None:
+        target = self.written
+        if target <= self.synced:
+            return
+        os.fsync(self.fd)
+        with self.synced_cond:
+            self.synced = max(self.synced, target)
+            self.synced_cond.notify_all()
+
+    def wait_synced(self, end: int) -> None:
+        with self.synced_cond:
+            while self.synced < end:
+                self.synced_cond.wait()
+
+    def scan(self) -> T.Iterator[tuple[int, int, int]]:
+        # -> (offset, kind, payload length) per complete record
+        size = self.written
+        mv = self.view(size) if size else memoryview(b"")
+        off = 0
+        while off + LOG_HEADER.size <= size:
+            n, kind = LOG_HEADER.unpack_from(mv, off)
+            if off + LOG_HEADER.size + n > size:
+                break
+            yield off, kind, n
+            off += LOG_HEADER.size + n
+        if off < size:
+            # torn tail from a crash mid-append: drop it, append after it
+            os.ftruncate(self.fd, off)
+            self.written = self.synced = off
+            self.mm, self.mv = None, memoryview(b"")
+
+    def close(self) -> None:
+        self.sync()
+        os.close(self.fd)
+
+
+# Writes append to a log and return once a group fsync covers them: one
+# committer thread fsyncs every `commit_interval`, for every waiting writer.
+# Reads slice the mmap'd log at offsets kept in a per-user index, which is
+# rebuilt by scanning the logs on startup
+class StorageLog:
+    threadsafe = True
+
+    def __init__(
+        self,
+        path: str,
+        shards: int = 8,
+        durable: bool = True,
+        commit_interval: float = 0.002,
+    ) -> None:
+        os.makedirs(path, exist_ok=True)
+        found = len([n for n in os.listdir(path) if n.startswith("messages-")])
+        if found and found != shards:
+            raise ValueError(f"Log has {found} shards, asked for {shards}")
+        self.durable = durable
+        self.commit_interval = commit_interval
+        self.meta = LogFile(os.path.join(path, "meta.log"))
+        self.shards = [
+            LogFile(os.path.join(path, f"messages-{i}.log"))
+            for i in range(shards)
+        ]
+        self.users: dict[str, None] = {}
+        self.creds: dict[str, str] = {}
+        self.cred_versions: dict[str, int] = {}
+        self.indexes: list[dict[str, array]] = [{} for _ in self.shards]
+        # search, per shard (under its lock). A user is indexed by their
+        # first search (one read of their messages), then kept up to date
+        self.search = [SearchIndex() for _ in self.shards]
+        self.load()
+        self.stop = threading.Event()
+        self.pending = threading.Event()  # set by writers, for the committer
+        self.committer = threading.Thread(
+            target=self.commit_loop, name="log-commit", daemon=True
+        )
+        self.committer.start()
+
+    def load(self) -> None:
+        mv = self.meta.view(self.meta.written)
+        for off, kind, n in self.meta.scan():
+            p = off + LOG_HEADER.size
+            end = p + n
+            if kind == LOG_KIND_USER:
+                self.users.setdefault(str(mv[p:end], "utf-8"), None)
+            elif kind == LOG_KIND_CRED:
+                (ulen,) = LOG_CRED.unpack_from(mv, p)
+                p += LOG_CRED.size
+                q = p + ulen
+                user = str(mv[p:q], "utf-8")
+                self.creds[user] = str(mv[q:end], "utf-8")
+                self.cred_versions[user] = self.cred_versions.get(user, 0) + 1
+        for shard, index in zip(self.shards, self.indexes):
+            mv = shard.view(shard.written)
+            # keyed by raw bytes while scanning; decode each user just once
+            raw: dict[bytes, array] = {}
+            for off, kind, _ in shard.scan():
+                if kind != LOG_KIND_MESSAGE:
+                    continue
+                p = off + LOG_HEADER.size
+                ulen, _ = LOG_MESSAGE.unpack_from(mv, p)
+                p += LOG_MESSAGE.size
+                q = p + ulen
+                user = mv[p:q].tobytes()
+                offs = raw.get(user)
+                if offs is None:
+                    offs = raw[user] = array("Q")
+                offs.append(off)
+            index.update((u.decode(), offs) for u, offs in raw.items())
+
+    def commit_loop(self) -> None:
+        # asleep until a write; then commit_interval for more to join it
+        while True:
+            self.pending.wait()
+            if self.stop.wait(self.commit_interval):
+                return
+            self.pending.clear()  # before syncing: later writes re-set it
+            for log in (self.meta, *self.shards):
+                log.sync()
+
+    def close(self) -> None:
+        self.stop.set()
+        self.pending.set()
+        self.committer.join()
+        for log in (self.meta, *self.shards):
+            log.close()
+
+    def shard_no(self, user: str) -> int:
+        # stable across restarts, unlike hash()
+        return zlib.crc32(user.encode()) % len(self.shards)
+
+    def append(self, log: LogFile, data: bytes) -> int:
+        with log.lock:
+            _, end = log.append(data)
+        return end
+
+    def wait(self, log: LogFile, end: int) -> None:
+        # every append comes through here, durable or not
+        self.pending.set()
+        if self.durable:
+            log.wait_synced(end)
+
+    def get_user(self, user: str) -> bool:
+        return user in self.users
+
+    def add_user(self, user: str) -> None:
+        self.add_users([user])
+
+    def add_users(self, users: T.Iterable[str]) -> None:
+        with self.meta.lock:
+            new = [u for u in dict.fromkeys(users) if u not in self.users]
+            if not new:
+                return
+            data = b"".join(log_record(LOG_KIND_USER, u.encode()) for u in new)
+            _, end = self.meta.append(data)
+            self.users.update(dict.fromkeys(new))
+        self.wait(self.meta, end)
+
+    def list_users(self) -> list[str]:
+        return list(self.users)
+
+    def get_cred(self, user: str) -> T.Optional[str]:
+        return self.creds.get(user)
+
+    def set_cred(self, user: str, cred: str) -> None:
+        if not self.get_user(user):
+            raise ValueError("Can't add a cred for a non-existant user")
+        u = user.encode()
+        data = log_record(
+            LOG_KIND_CRED, LOG_CRED.pack(len(u)) + u + cred.encode()
+        )
+        with self.meta.lock:
+            _, end = self.meta.append(data)
+            self.creds[user] = cred
+            self.cred_versions[user] = self.cred_versions.get(user, 0) + 1
+        self.wait(self.meta, end)
+
+    def read_message(self, mv: memoryview, off: int) -> Message:
+        n, _ = LOG_HEADER.unpack_from(mv, off)
+        p = off + LOG_HEADER.size
+        end = p + n
+        ulen, flen = LOG_MESSAGE.unpack_from(mv, p)
+        p += LOG_MESSAGE.size + ulen
+        # decoded straight out of the map; no intermediate bytes copies
+        q = p + flen
+        return Message(str(mv[p:q], "utf-8"), str(mv[q:end], "utf-8"))
+
+    def offsets(
+        self, user: str, start: int = 0, stop: T.Optional[int] = None
+    ) -> tuple[T.Optional[array], int, memoryview]:
+        no = self.shard_no(user)
+        log = self.shards[no]
+        with log.lock:
+            offs = self.indexes[no].get(user)
+            total = len(offs) if offs is not None else 0
+            # copy the slice under the lock; appends may grow the array
+            offs = offs[start:stop] if offs is not None else None
+            end = log.written
+        return offs, total, log.view(end) if end else memoryview(b"")
+
+    def get_messages(self, user: str) -> T.Optional[list[Message]]:
+        offs, _, mv = self.offsets(user)
+        if offs is None:
+            return None
+        return [self.read_message(mv, off) for off in offs]
+
+    def get_messages_page(
+        self, user: str, cursor: T.Optional[int], limit: int
+    ) -> MessagePage:
+        # same cursor as StorageMem: the position in the user's message list
+        start = cursor or 0
+        end = start + limit
+        offs, total, mv = self.offsets(user, start, end)
+        msgs = [self.read_message(mv, off) for off in offs or ()]
+        return MessagePage(
+            msgs,
+            end if end < total else None,
+            max(start - limit, 0) if start > 0 else None,
+        )
+
+    def add_message(self, user: str, msg: Message) -> None:
+        self.add_messages_bulk([(user, msg)])
+
+    def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        by_shard: dict[int, list[tuple[str, Message, bytes]]] = {}
+        for user, msg in msgs:
+            rec = log_message_record(user, msg)
+            by_shard.setdefault(self.shard_no(user), []).append(
+                (user, msg, rec)
+            )
+        ends = []
+        for no, recs in by_shard.items():
+            log, index = self.shards[no], self.indexes[no]
+            with log.lock:
+                off, end = log.append(b"".join(rec for _, _, rec in recs))
+                search = self.search[no]
+                for user, msg, rec in recs:
+                    offs = index.get(user)
+                    if offs is None:
+                        offs = index[user] = array("Q")
+                    offs.append(off)
+                    off += len(rec)
+                    if user in search.counts:
+                        search.add(user, msg)
+            ends.append((log, end))
+        for log, end in ends:
+            self.wait(log, end)
+
+    def get_version(self, user: str) -> int:
+        no = self.shard_no(user)
+        offs = self.indexes[no].get(user)
+        n_msgs = len(offs) if offs is not None else 0
+        return n_msgs + self.cred_versions.get(user, 0)
+
+    def search_messages(
+        self, user: str, query: str, limit: int
+    ) -> list[Message]:
+        no = self.shard_no(user)
+        log = self.shards[no]
+        with log.lock:
+            search = self.search[no]
+            offs = self.indexes[no].get(user)
+            if not offs:
+                return []
+            if user not in search.counts:
+                mv = log.view_locked(log.written)
+                search.add_all(
+                    user, (self.read_message(mv, off) for off in offs)
+                )
+            positions = search.search(user, parse_query(query), limit)
+            if not positions:
+                return []
+            picked = [offs[i] for i in positions]
+            end = log.written
+        mv = log.view(end)
+        return [self.read_message(mv, off) for off in picked]
+
+
+Storage.register(StorageLog)
+
+# Several worker processes each with a StorageMem means several inboxes. So
+# run one storage process, and have every worker talk to it over a Unix
+# socket (multiprocessing's manager protocol: pickled calls + results)
+
+
+def make_storage_server(
+    address: T.Any, authkey: bytes, sto: Storage
+) -> "multiprocessing.managers.Server":
+    import multiprocessing.managers
+
+    # one shared object: every client's proxy gets this same `sto`
+    registry = {"storage": (lambda: sto, None, None, None)}
+    return multiprocessing.managers.Server(
+        registry, address, authkey, "pickle"
+    )
+
+
+@functools.cache
+def get_storage_manager() -> type["multiprocessing.managers.BaseManager"]:
+    import multiprocessing.managers
+
+    class StorageManager(multiprocessing.managers.BaseManager):
+        pass
+
+    StorageManager.register("storage")
+    return StorageManager
+
+
+# Each call is a round trip. Proxies keep a connection per thread, so this
+# is safe to share between a worker's threads. multiprocessing only fixes
+# proxies up in processes it starts, so after a plain fork the child drops
+# the parent's proxy and connects again on first use
+class StorageRemote:
+    threadsafe = True
+
+    def __init__(self, address: T.Any, authkey: bytes) -> None:
+        self.address = address
+        self.authkey = authkey
+        self.lock = threading.Lock()
+        self.remote: T.Any = self.connect()
+        AFTER_FORK.add(self)
+
+    def connect(self) -> T.Any:
+        manager = get_storage_manager()(
+            address=self.address, authkey=self.authkey
+        )
+        manager.connect()
+        return manager.storage()  # type: ignore[attr-defined]
+
+    @property
+    def proxy(self) -> T.Any:
+        remote = self.remote
+        if remote is None:
+            with self.lock:
+                if self.remote is None:
+                    self.remote = self.connect()
+                remote = self.remote
+        return remote
+
+    def after_fork(self) -> None:
+        stale = self.remote
+        if stale is not None:
+            # its finalizer would decref the parent's object on the server,
+            # and its thread's connection is the parent's socket
+            stale._close.cancel()
+            if hasattr(stale._tls, "connection"):
+                del stale._tls.connection
+        self.lock = threading.Lock()
+        self.remote = None
+
+    def get_user(self, user: str) -> bool:
+        return self.proxy.get_user(user)
+
+    def add_user(self, user: str) -> None:
+        self.proxy.add_user(user)
+
+    def add_users(self, users: T.Iterable[str]) -> None:
+        self.proxy.add_users(list(users))
+
+    def list_users(self) -> list[str]:
+        return self.proxy.list_users()
+
+    def get_cred(self, user: str) -> T.Optional[str]:
+        return self.proxy.get_cred(user)
+
+    def set_cred(self, user: str, cred: str) -> None:
+        self.proxy.set_cred(user, cred)
+
+    def get_messages(self, user: str) -> T.Optional[list[Message]]:
+        return self.proxy.get_messages(user)
+
+    def get_messages_page(
+        self, user: str, cursor: T.Optional[int], limit: int
+    ) -> MessagePage:
+        return self.proxy.get_messages_page(user, cursor, limit)
+
+    def add_message(self, user: str, msg: Message) -> None:
+        self.proxy.add_message(user, msg)
+
+    def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        self.proxy.add_messages_bulk(msgs)
+
+    def get_version(self, user: str) -> int:
+        return self.proxy.get_version(user)
+
+    def search_messages(
+        self, user: str, query: str, limit: int
+    ) -> list[Message]:
+        return self.proxy.search_messages(user, query, limit)
+
+
+Storage.register(StorageRemote)
+
+
+def get_remote_authkey() -> bytes:
+    authkey = os.environ.get("STORAGE_REMOTE_AUTHKEY")
+    if not authkey:
+        raise ValueError("STORAGE_REMOTE_AUTHKEY must be set")
+    return authkey.encode()
+
+
+STORAGE_REMOTE_ADDRESS = os.environ.get(
+    "STORAGE_REMOTE_ADDRESS", "storage.sock"
+)
+
+# name -> constructor; the app picks one at startup via STORAGE_BACKEND
+STORAGE_BACKENDS: dict[str, T.Callable[[], Storage]] = {
+    "mem": StorageMem,
+    "mem_compact": lambda: StorageMem(compact=True),
+    "sharded": lambda: StorageSharded(
+        int(os.environ.get("STORAGE_SHARDS", 16))
+    ),
+    "sqlite": lambda: StorageSQLite(
+        os.environ.get("STORAGE_SQLITE_PATH", "storage.sqlite3")
+    ),
+    "remote": lambda: StorageRemote(
+        STORAGE_REMOTE_ADDRESS, get_remote_authkey()
+    ),
+    "log": lambda: StorageLog(
+        os.environ.get("STORAGE_LOG_PATH", "storage-log")
+    ),
+}
+
+
+def init_storage(
+    app: flask.Flask, backend: str = "mem", seed_data: bool = True
+) -> Storage:
+    # once per app, not per request. Seeding happens here, and only here
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    sto = STORAGE_BACKENDS[backend]()
+    # persistent backends keep last run's seed; only seed an empty store
+    if seed_data and not sto.list_users():
+        seed(sto)
+    if not getattr(sto, "threadsafe", False):
+        sto = StorageLocked(sto)
+    app.extensions["storage"] = sto
+    return sto
+
+
+# creds: storage only ever sees "kdf$cost$salt$hash" strings. Each hash
+# records its own KDF + cost, so the default can change without a migration
+
+
+@dataclass(frozen=True)
+class Kdf:
+    name: str  # "scrypt" | "pbkdf2_sha256"
+    cost: int  # scrypt: N (a power of 2); pbkdf2: iterations
+
+    def derive(self, cred: str, salt: bytes) -> bytes:
+        if self.name == "scrypt":
+            # r=8, p=1: N=2**14 is ~16MB and some tens of ms
+            return hashlib.scrypt(
+                cred.encode(), salt=salt, n=self.cost, r=8, p=1, maxmem=2**26
+            )
+        if self.name == "pbkdf2_sha256":
+            return hashlib.pbkdf2_hmac(
+                "sha256", cred.encode(), salt, self.cost
+            )
+        raise ValueError(f"Unknown KDF: {self.name}")
+
+
+KDF_COST_DEFAULT = {"scrypt": 2**14, "pbkdf2_sha256": 600_000}
+KDF_NAME = os.environ.get("CRED_KDF", "scrypt")
+KDF_DEFAULT = Kdf(
+    KDF_NAME,
+    int(os.environ.get("CRED_KDF_COST", KDF_COST_DEFAULT.get(KDF_NAME, 0))),
+)
+
+
+def hash_cred(cred: str, kdf: Kdf = KDF_DEFAULT) -> str:
+    salt = os.urandom(16)
+    return f"{kdf.name}${kdf.cost}${salt.hex()}${kdf.derive(cred, salt).hex()}"
+
+
+def verify_cred(stored: str, cred_in: str) -> bool:
+    try:
+        name, cost, salt, want = stored.split("$")
+        kdf = Kdf(name, int(cost))
+        got = kdf.derive(cred_in, bytes.fromhex(salt))
+        want_bytes = bytes.fromhex(want)
+    except ValueError:
+        # malformed or plaintext (pre-hashing) cred: never matches
+        return False
+    return hmac.compare_digest(got, want_bytes)
+
+
+@functools.cache
+def get_dummy_cred() -> str:
+    # unknown users still pay for a KDF, so timing doesn't leak who exists
+    return hash_cred("")
+
+
+# The KDF is slow on purpose. hashlib drops the GIL while it runs, so do it
+# on a few pool threads, with a cap on how many logins can queue for them.
+# Successful checks are remembered for a while, so re-logins skip the KDF
+class CredChecker:
+    def __init__(
+        self,
+        workers: int = 4,
+        queue: int = 64,
+        ttl: float = 300.0,
+        cache_size: int = 1024,
+    ) -> None:
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="cred"
+        )
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache: collections.OrderedDict[bytes, float] = (
+            collections.OrderedDict()
+        )
+        self.lock = threading.Lock()
+        # keys the cache, so it never holds anything a cred could be read from
+        self.key = os.urandom(32)
+
+    def cache_key(self, user: str, stored: str, cred_in: str) -> bytes:
+        # includes the stored hash: a set_cred makes old entries unreachable
+        msg = "\0".join((user, stored, cred_in)).encode()
+        return hmac.digest(self.key, msg, "sha256")
+
+    def verify(self, stored: str, cred_in: str) -> bool:
+        # raises TimeoutError when there's already a full queue of logins
+        if not self.slots.acquire(timeout=1.0):
+            raise TimeoutError("Credential check queue is full")
+        try:
+            return self.pool.submit(verify_cred, stored, cred_in).result()
+        finally:
+            self.slots.release()
+
+    def check(self, user: str, stored: T.Optional[str], cred_in: str) -> bool:
+        if stored is None:
+            # same queue as a real check: unknown-user stuffing is bounded too
+            self.verify(get_dummy_cred(), cred_in)
+            return False
+        key = self.cache_key(user, stored, cred_in)
+        now = time.monotonic()
+        with self.lock:
+            expiry = self.cache.get(key)
+            if expiry is not None and expiry > now:
+                return True
+        ok = self.verify(stored, cred_in)
+        if ok and self.ttl > 0:
+            with self.lock:
+                self.cache[key] = now + self.ttl
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return ok
+
+
+def init_cred_checker(app: flask.Flask, **kwargs: T.Any) -> CredChecker:
+    checker = CredChecker(**kwargs)
+    app.extensions["cred_checker"] = checker
+    return checker
+
+
+@timed("check_cred")
 def check_cred(sto: Storage, user: str, cred_in: str) -> bool:
     cred = sto.get_cred(user)
     # print(user, cred_in, cred)  # NOTE: for debugging fail (missed seed)
-    if cred_in == cred:
-        return True
-    return False
+    return check_cred_stored(user, cred, cred_in)
+
+
+def check_cred_stored(user: str, cred: T.Optional[str], cred_in: str) -> bool:
+    if flask.has_app_context():
+        checker = flask.current_app.extensions.get("cred_checker")
+        if checker is not None:
+            return checker.check(user, cred, cred_in)
+    if cred is None:
+        verify_cred(get_dummy_cred(), cred_in)
+        return False
+    return verify_cred(cred, cred_in)
+
+
+# templates: tokenize mustache source once, render from the tokens after
+
+
+@dataclass
+class Template:
+    name: str
+    tokens: list[tuple[str, str]]
+    parse_ns: int
+    renders: int = 0
+    render_ns: int = 0
+
+    def render(self, data: T.Any) -> str:
+        start = time.perf_counter_ns()
+        # chevron skips its tokenizer when handed a token list, not a str
+        result = chevron.render(self.tokens, data)
+        self.record(start)
+        return result
+
+    def record(self, start: int) -> None:
+        # also called by the fast paths that render from these tokens.
+        # NOTE: unlocked; under threads a count may be lost. Fine for stats
+        self.render_ns += time.perf_counter_ns() - start
+        self.renders += 1
+
+
+TEMPLATES: dict[str, Template] = {}
+
+
+def register_template(name: str, source: str) -> Template:
+    start = time.perf_counter_ns()
+    tokens = list(chevron.tokenizer.tokenize(source))
+    tmpl = Template(name, tokens, time.perf_counter_ns() - start)
+    TEMPLATES[name] = tmpl
+    return tmpl
+
+
+def get_template_stats() -> dict[str, dict[str, int]]:
+    # saved_ns: roughly what re-tokenizing on every render would have cost
+    return {
+        name: {
+            "renders": tmpl.renders,
+            "render_ns": tmpl.render_ns,
+            "parse_ns": tmpl.parse_ns,
+            "saved_ns": tmpl.parse_ns * tmpl.renders,
+        }
+        for name, tmpl in TEMPLATES.items()
+    }
 
 
 # index
 
 
-@dataclass(frozen=True)
+# slots: no per-instance __dict__; the renderer reads attributes directly
+@dataclass(frozen=True, slots=True)
 class ParamsBody:
     title: str
     url_for_index: str
@@ -160,8 +1750,70 @@ class ParamsBody:
     user: T.Optional[str]
 
 
+# url_for builds through werkzeug's MapAdapter every call, for URLs that
+# only change with the rules, where the app is mounted, and the host. So
+# key on exactly those, and cache: a new key just misses (old ones age out)
+URL_CACHE_USERS = 4096
+
+
+def get_url_key() -> T.Optional[tuple]:
+    # the request's adapter has all of it, for one context lookup (each
+    # flask.request.* / current_app.* attribute is a proxy hop of its own)
+    if flask.has_request_context():
+        adapter = flask.globals.request_ctx.url_adapter
+        external = False
+    else:
+        # app context only (CLI, jobs): url_for builds external URLs with
+        # the app's adapter, from SERVER_NAME. None: no adapter, no cache
+        adapter = flask.current_app.create_url_adapter(None)
+        if adapter is None:
+            return None
+        external = True
+    url_map = adapter.map
+    return (
+        id(url_map),
+        url_map.version,
+        adapter.script_name,
+        adapter.server_name,
+        adapter.subdomain,
+        adapter.url_scheme,
+        external,
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def get_url_cached(key: tuple, endpoint: str) -> str:
+    return flask.url_for(endpoint)
+
+
+# bounded: one entry per user seen recently
+@functools.lru_cache(maxsize=URL_CACHE_USERS)
+def get_user_url_cached(key: tuple, user: T.Optional[str]) -> str:
+    return flask.url_for("user_msg", user=user)
+
+
+@timed("url_for")
 def get_body_params(
     title: str, header: str, content: str, user: T.Optional[str]
+) -> ParamsBody:
+    key = get_url_key()
+    if key is None:  # url_for raises its usual error
+        return get_body_params_url_for(title, header, content, user)
+    return ParamsBody(
+        title,
+        get_url_cached(key, "index"),
+        get_url_cached(key, "login_get"),
+        get_url_cached(key, "logout"),
+        get_user_url_cached(key, user),
+        header,
+        content,
+        user,
+    )
+
+
+# Slow path: url_for every time. The reference for the above (and to bench)
+def get_body_params_url_for(
+    title: str, header: str, content: str, user: T.Optional[str]
 ) -> ParamsBody:
     return ParamsBody(
         title,
@@ -175,8 +1827,9 @@ def get_body_params(
     )
 
 
-def get_body_template(params: ParamsBody) -> str:
-    tmpl = """
+TMPL_BODY = register_template(
+    "body",
+    """
 <!doctype html>
 <title>{{title}}</title>
 <nav>
@@ -197,34 +1850,433 @@ def get_body_template(params: ParamsBody) -> str:
     </header>
     {{{content}}}
 </section>
-    """
-    return chevron.render(tmpl, dataclasses.asdict(params))
+    """,
+)
+
+
+# Fast path: the body only changes per request in these top-level tags.
+# Everything else (the nav) depends on user + url_for_*, so pre-render it
+BODY_SLOTS = ("title", "header", "content")
+Fragment = T.Union[tuple[str, str], list[tuple[str, str]]]
+
+
+def split_fragments(
+    tokens: list[tuple[str, str]], slots: tuple[str, ...]
+) -> list[Fragment]:
+    # top-level slot tags stay (tag, key); runs between them become lists
+    parts: list[Fragment] = []
+    run: list[tuple[str, str]] = []
+    depth = 0
+    for tag, key in tokens:
+        if depth == 0 and tag in ("variable", "no escape") and key in slots:
+            if run:
+                parts.append(run)
+                run = []
+            parts.append((tag, key))
+            continue
+        if key in slots:
+            raise ValueError(f"Slot {key} can't be nested in a section")
+        if tag in ("section", "inverted section"):
+            depth += 1
+        elif tag == "end":
+            depth -= 1
+        run.append((tag, key))
+    if run:
+        parts.append(run)
+    return parts
+
+
+BODY_PARTS = split_fragments(TMPL_BODY.tokens, BODY_SLOTS)
+
+
+def html_escape(s: str) -> str:
+    # same as chevron's escape for {{var}}, so output is byte-identical
+    return (
+        s.replace("&", "&amp;")
+        .replace('"', "&quot;")
+        .replace("<", "&lt;")
+        .replace(">", "&gt;")
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def get_body_fragments(
+    user: T.Optional[str],
+    url_for_index: str,
+    url_for_login: str,
+    url_for_logout: str,
+    url_for_user: str,
+) -> tuple[str, ...]:
+    data = {
+        "user": user,
+        "url_for_index": url_for_index,
+        "url_for_login": url_for_login,
+        "url_for_logout": url_for_logout,
+        "url_for_user": url_for_user,
+    }
+    return tuple(
+        chevron.render(part, data) for part in BODY_PARTS if type(part) is list
+    )
 
 
-@app.route("/")
+def iter_body_template(
+    params: ParamsBody, content: T.Optional[T.Iterable[str]] = None
+) -> T.Iterator[str]:
+    # `content`, if given, is streamed into the content slot piece by piece
+    static = iter(
+        get_body_fragments(
+            params.user,
+            params.url_for_index,
+            params.url_for_login,
+            params.url_for_logout,
+            params.url_for_user,
+        )
+    )
+    for part in BODY_PARTS:
+        if type(part) is list:
+            yield next(static)
+            continue
+        tag, key = part
+        if key == "content" and content is not None:
+            yield from content
+            continue
+        val = getattr(params, key)
+        val = "" if val is None else str(val)
+        yield html_escape(val) if tag == "variable" else val
+
+
+@timed("render.body")
+def get_body_template(params: ParamsBody) -> str:
+    start = time.perf_counter_ns()
+    result = "".join(iter_body_template(params))
+    TMPL_BODY.record(start)
+    return result
+
+
+# Slow path, kept as the reference the fast path must match (and to bench)
+def get_body_template_chevron(params: ParamsBody) -> str:
+    return TMPL_BODY.render(dataclasses.asdict(params))
+
+
+# conditional GET: pages are a pure function of (route, user, storage
+# version, templates), so hash those into a strong ETag. A matching
+# If-None-Match gets a 304 before anything is fetched or rendered
+
+
+@functools.cache
+def get_template_version() -> str:
+    # computed on first request, after every template has registered
+    h = hashlib.sha256()
+    for name, tmpl in sorted(TEMPLATES.items()):
+        h.update(repr((name, tmpl.tokens)).encode())
+    h.update(get_auth_template_content().encode())
+    return h.hexdigest()[:16]
+
+
+def get_etag(*parts: T.Any) -> str:
+    key = repr((parts, flask.request.script_root, get_template_version()))
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def conditional(etag: str, render: T.Callable[[], T.Any]) -> flask.Response:
+    if flask.request.if_none_match.contains(etag):
+        resp = flask.Response(status=304)
+    else:
+        resp = flask.make_response(render())
+    resp.set_etag(etag)
+    # depends on who's logged in, so: per-client, and always revalidate
+    resp.vary.add("Cookie")
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+
+# rendered-page cache: one entry per (route, url, user), tagged with the
+# user's storage version. A version bump makes the entry miss (and go);
+# otherwise LRU eviction keeps it under a byte budget
+
+
+class PageCache:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries: collections.OrderedDict[
+            tuple, tuple[int, bytes, list[tuple[str, str]]]
+        ] = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def drop(self, key: tuple) -> None:
+        _, body, _ = self.entries.pop(key)
+        self.bytes -= len(body)
+
+    def get(
+        self, key: tuple, version: int
+    ) -> T.Optional[tuple[bytes, list[tuple[str, str]]]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] != version:
+                self.drop(key)
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(
+        self,
+        key: tuple,
+        version: int,
+        body: bytes,
+        headers: list[tuple[str, str]],
+    ) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (version, body, headers)
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                _, (_, old, _) = self.entries.popitem(last=False)
+                self.bytes -= len(old)
+                self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def init_page_cache(app: flask.Flask, max_bytes: int) -> T.Optional[PageCache]:
+    # 0 turns it off; cached_page views then just call through
+    cache = PageCache(max_bytes) if max_bytes > 0 else None
+    app.extensions["page_cache"] = cache
+    return cache
+
+
+def cached_page(view: T.Callable) -> T.Callable:
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = flask.current_app.extensions.get("page_cache")
+        if cache is None:
+            return view(*args, **kwargs)
+        req = flask.request
+        user = flask.session.get("user")
+        key = (req.endpoint, req.script_root, req.full_path, user)
+        version = get_storage_flask().get_version(user) if user else 0
+        hit = cache.get(key, version)
+        if hit is not None:
+            body, headers = hit
+            resp = flask.Response(body, headers=headers)
+            # still honour If-None-Match against the cached ETag
+            return resp.make_conditional(req)
+        resp = flask.make_response(view(*args, **kwargs))
+        # 304s have no body, and streams are big on purpose: skip both
+        if resp.status_code == 200 and not resp.is_streamed:
+            headers = list(resp.headers.items())
+            cache.put(key, version, resp.get_data(), headers)
+        return resp
+
+    return wrapper
+
+
+@route("/")
+@cached_page
 def index():
-    content = "Hello, World!"
-    header = "index"
     user = flask.session.get("user")
-    params = get_body_params("index", header, content, user)
-    return get_body_template(params)
+
+    def render():
+        content = "Hello, World!"
+        header = "index"
+        params = get_body_params("index", header, content, user)
+        return get_body_template(params)
+
+    return conditional(get_etag("index", user), render)
 
 
 # user
 
 
-def get_user_template_content(messages: list[Message]) -> str:
-    # TODO: could look much better; later
-    tmpl = """
+TMPL_USER_CONTENT = register_template(
+    "user_content",
+    """
 <div class="messages">
-{{{messages}}}
+{{#messages}}
+    <article class="message"><b>{{frm}}</b>: {{msg}}</article>
+{{/messages}}
+{{^messages}}
+    <p>No messages.</p>
+{{/messages}}
 </div>
-    """
-    return chevron.render(tmpl, {"messages": messages})
+<nav class="pages">
+    {{#url_prev}}<a href="{{url_prev}}">prev</a>{{/url_prev}}
+    {{#url_next}}<a href="{{url_next}}">next</a>{{/url_next}}
+</nav>
+    """,
+)
+
+
+def split_section(
+    tokens: list[tuple[str, str]], key: str
+) -> tuple[list[tuple[str, str]], ...]:
+    # -> (before, inside, after) the first top-level {{#key}}...{{/key}}
+    depth = 0
+    start = None
+    for i, (tag, k) in enumerate(tokens):
+        if tag in ("section", "inverted section"):
+            if depth == 0 and tag == "section" and k == key:
+                start = i
+            depth += 1
+        elif tag == "end":
+            depth -= 1
+            if depth == 0 and start is not None:
+                inside, after = slice(start + 1, i), slice(i + 1, None)
+                return tokens[:start], tokens[inside], tokens[after]
+    raise ValueError(f"No top-level section {key}")
+
+
+# The loop body is rendered per message and cached: Message is frozen, so
+# a message's HTML never changes. Only the (small) rest is rendered per hit
+USER_CONTENT_BEFORE, MESSAGE_TOKENS, USER_CONTENT_AFTER = split_section(
+    TMPL_USER_CONTENT.tokens, "messages"
+)
+MESSAGE_FRAGMENT_CACHE_SIZE = 65536
+# longer messages render uncached. Escaping can grow text 6x ('"' is
+# &quot;), so this bounds the cache at ~65536 x 1.5KB, not x 24KB
+MESSAGE_FRAGMENT_CACHE_MAX_LEN = 256
+if any(tag not in ("literal", "variable") for tag, _ in MESSAGE_TOKENS):
+    raise ValueError("Message template must be flat: literals + {{vars}}")
+
+
+def render_message_fragment(msg: Message) -> str:
+    # flat template, so no need for chevron: join literals + escaped fields
+    return "".join(
+        key if tag == "literal" else html_escape(getattr(msg, key))
+        for tag, key in MESSAGE_TOKENS
+    )
+
+
+get_message_fragment_cached = functools.lru_cache(
+    maxsize=MESSAGE_FRAGMENT_CACHE_SIZE
+)(render_message_fragment)
+
+
+def get_message_fragment(msg: Message) -> str:
+    if len(msg.msg) + len(msg.frm) > MESSAGE_FRAGMENT_CACHE_MAX_LEN:
+        return render_message_fragment(msg)
+    return get_message_fragment_cached(msg)
+
+
+MESSAGES_LIMIT_DEFAULT = 50
+MESSAGES_LIMIT_MAX = 500
+
+
+@timed("render.user")
+def get_user_template_content(
+    messages: list[Message],
+    url_prev: T.Optional[str] = None,
+    url_next: T.Optional[str] = None,
+) -> str:
+    start = time.perf_counter_ns()
+    data = {"messages": messages, "url_prev": url_prev, "url_next": url_next}
+    result = "".join(
+        (
+            chevron.render(USER_CONTENT_BEFORE, data),
+            "".join(map(get_message_fragment, messages)),
+            chevron.render(USER_CONTENT_AFTER, data),
+        )
+    )
+    TMPL_USER_CONTENT.record(start)
+    return result
+
+
+# Slow path, the reference for the above
+def get_user_template_content_chevron(
+    messages: list[Message],
+    url_prev: T.Optional[str] = None,
+    url_next: T.Optional[str] = None,
+) -> str:
+    return TMPL_USER_CONTENT.render(
+        {"messages": messages, "url_prev": url_prev, "url_next": url_next}
+    )
+
+
+def get_page_args() -> tuple[T.Optional[int], int]:
+    args = flask.request.args
+    try:
+        # not args.get(type=int): that turns bad input into None, silently
+        raw = args.get("cursor")
+        cursor = int(raw) if raw is not None else None
+        limit = int(args.get("limit", MESSAGES_LIMIT_DEFAULT))
+    except ValueError:
+        flask.abort(400)
+    if limit < 1 or (cursor is not None and cursor < 0):
+        flask.abort(400)
+    return cursor, min(limit, MESSAGES_LIMIT_MAX)
+
+
+def get_page_url(
+    user: str, cursor: T.Optional[int], limit: int
+) -> T.Optional[str]:
+    if cursor is None:
+        return None
+    return flask.url_for("user_msg", user=user, cursor=cursor, limit=limit)
+
+
+# Streaming: TTFB and memory stay flat no matter how big the inbox is.
+# No paging here; the whole inbox goes out, a storage page at a time
+STREAM_CHUNK = 500
+
+
+def iter_messages(
+    sto: Storage, user: str, chunk: int = STREAM_CHUNK
+) -> T.Iterator[Message]:
+    cursor = None
+    while True:
+        page = sto.get_messages_page(user, cursor, chunk)
+        yield from page.messages
+        if page.next_cursor is None:
+            return
+        cursor = page.next_cursor
+
+
+def iter_user_template_content(
+    messages: T.Iterable[Message],
+) -> T.Iterator[str]:
+    yield chevron.render(USER_CONTENT_BEFORE, {})
+    n = 0
+    for msg in messages:
+        # uncached: a huge inbox would just churn the fragment cache
+        yield render_message_fragment(msg)
+        n += 1
+    yield chevron.render(USER_CONTENT_AFTER, {"messages": n > 0})
+
+
+def user_msg_stream(sto: Storage, user: str) -> flask.Response:
+    header = f"User {user}"
+    params = get_body_params("user", header, "", user)
+    content = iter_user_template_content(iter_messages(sto, user))
+    body = flask.stream_with_context(iter_body_template(params, content))
+    return flask.Response(body, mimetype="text/html")
 
 
-@app.route("/user")
-@app.route("/user/<user>")
+@route("/user")
+@route("/user/<user>")
+@cached_page
 def user_msg(user: T.Optional[str] = None):
     user = str(markupsafe.escape(user)) if user is not None else None
     sto = get_storage_flask()
@@ -232,12 +2284,169 @@ def user_msg(user: T.Optional[str] = None):
         flask.abort(404)
     if user != flask.session.get("user"):
         flask.abort(403)
-    content = get_user_template_content(sto.get_messages(user))
-    header = f"User {user}"
-    params = get_body_params("user", header, content, user)
-    result = get_body_template(params)
-    # print(result)  # this is how I debugged the markupsafe issue
-    return result
+    stream = flask.current_app.config.get("STREAM_MESSAGES", False)
+    cursor, limit = get_page_args()
+    version = sto.get_version(user)
+    etag = get_etag("user_msg", user, version, stream, cursor, limit)
+
+    def render():
+        if stream:
+            return user_msg_stream(sto, user)
+        page = sto.get_messages_page(user, cursor, limit)
+        content = get_user_template_content(
+            page.messages,
+            get_page_url(user, page.prev_cursor, limit),
+            get_page_url(user, page.next_cursor, limit),
+        )
+        header = f"User {user}"
+        params = get_body_params("user", header, content, user)
+        result = get_body_template(params)
+        # print(result)  # this is how I debugged the markupsafe issue
+        return result
+
+    return conditional(etag, render)
+
+
+# rate limiting: token buckets, refilled lazily (tokens since the last hit,
+# worked out on the next one), so no timers. Buckets live in fixed-size
+# arrays: a key hashes to one slot in one shard. Another key landing on a
+# taken slot takes it over with a full bucket - so memory never grows, and
+# under pressure it fails open, like an LRU evicting
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        burst: float,
+        per_second: float,
+        slots: int = 65536,
+        shards: int = 16,
+    ) -> None:
+        self.burst = burst
+        self.per_second = per_second
+        self.shards = shards
+        self.slots = slots // shards
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.hashes = [
+            array("q", bytes(8 * self.slots)) for _ in range(shards)
+        ]
+        self.tokens = [
+            array("d", bytes(8 * self.slots)) for _ in range(shards)
+        ]
+        self.stamps = [
+            array("d", bytes(8 * self.slots)) for _ in range(shards)
+        ]
+        self.allowed = 0
+        self.limited = 0
+        self.takeovers = 0
+
+    def acquire(self, key: str) -> float:
+        # 0.0 if allowed; else seconds until a token is there
+        h = hash(key) or 1  # 0 marks a free slot
+        no = h % self.shards
+        slot = (h // self.shards) % self.slots
+        hashes, tokens, stamps = (
+            self.hashes[no],
+            self.tokens[no],
+            self.stamps[no],
+        )
+        now = time.monotonic()
+        with self.locks[no]:
+            if hashes[slot] != h:
+                if hashes[slot]:
+                    self.takeovers += 1
+                hashes[slot] = h
+                tokens[slot] = self.burst
+                stamps[slot] = now
+            t = tokens[slot] + (now - stamps[slot]) * self.per_second
+            t = min(t, self.burst)
+            stamps[slot] = now
+            if t >= 1:
+                tokens[slot] = t - 1
+                self.allowed += 1
+                return 0.0
+            tokens[slot] = t
+            self.limited += 1
+            return (1 - t) / self.per_second
+
+    def stats(self) -> dict[str, int]:
+        # NOTE: read unlocked; fine for monitoring
+        return {
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "takeovers": self.takeovers,
+        }
+
+
+def parse_rate(rate: str) -> T.Optional[tuple[float, float]]:
+    # "20/60": bursts of 20, refilled at 20 per 60s. Empty or 0: no limit
+    if not rate or rate == "0":
+        return None
+    burst, _, seconds = rate.partition("/")
+    return float(burst), float(burst) / float(seconds or 1)
+
+
+def init_rate_limits(
+    app: flask.Flask, rates: dict[str, str]
+) -> dict[str, RateLimiter]:
+    limiters = {}
+    for name, rate in rates.items():
+        parsed = parse_rate(rate)
+        if parsed is not None:
+            limiters[name] = RateLimiter(*parsed)
+    app.extensions["rate_limits"] = limiters
+    return limiters
+
+
+def too_many_requests(retry_after: float) -> T.NoReturn:
+    resp = flask.Response("Too Many Requests", 429, mimetype="text/plain")
+    resp.headers["Retry-After"] = str(math.ceil(retry_after))
+    flask.abort(resp)
+
+
+def check_rate_limit(name: str, key: T.Callable[[], T.Optional[str]]) -> None:
+    limiter = flask.current_app.extensions.get("rate_limits", {}).get(name)
+    if limiter is None:
+        return
+    k = key()
+    if k is None:
+        return
+    retry_after = limiter.acquire(k)
+    if retry_after:
+        too_many_requests(retry_after)
+
+
+def rate_limited(
+    name: str, key: T.Callable[[], T.Optional[str]]
+) -> T.Callable[[T.Callable], T.Callable]:
+    # the limiter `name` (see RATE_LIMITS), per key(); unconfigured: no-op
+    def decorator(view: T.Callable) -> T.Callable:
+        if inspect.iscoroutinefunction(view):
+
+            @functools.wraps(view)
+            async def wrapper_async(*args, **kwargs):
+                check_rate_limit(name, key)
+                return await view(*args, **kwargs)
+
+            return wrapper_async
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            check_rate_limit(name, key)
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_client_ip() -> T.Optional[str]:
+    # NOTE: behind a proxy, this is the proxy; see werkzeug's ProxyFix
+    return flask.request.remote_addr
+
+
+def get_form_username() -> T.Optional[str]:
+    return flask.request.form.get("username")
 
 
 # auth: login & logout
@@ -255,81 +2464,964 @@ def get_auth_template_content() -> str:
     """
 
 
-@app.get("/login")
+@route("/login", methods=["GET"])
+@cached_page
 def login_get():
-    content = get_auth_template_content()
-    header = "login"
     user = flask.session.get("user")
-    params = get_body_params("index", header, content, user)
-    return get_body_template(params)
+
+    def render():
+        content = get_auth_template_content()
+        header = "login"
+        params = get_body_params("index", header, content, user)
+        return get_body_template(params)
+
+    return conditional(get_etag("login_get", user), render)
 
 
-@app.post("/login")
+# by IP first: a stuffing run tries many usernames from few addresses
+@route("/login", methods=["POST"])
+@rate_limited("login_ip", get_client_ip)
+@rate_limited("login_user", get_form_username)
 def login_post():
     user = flask.request.form.get("username")
     pswd = flask.request.form.get("password")
     sto = get_storage_flask()
-    if user is None:
+    if user is None or pswd is None:
         flask.abort(403)
-    if check_cred(sto, user, pswd):
+    try:
+        ok = check_cred(sto, user, pswd)
+    except TimeoutError:
+        flask.abort(503)
+    if ok:
         flask.session.clear()
         flask.session["user"] = user
     return flask.redirect(flask.url_for("index"))
 
 
-@app.route("/logout")
+@route("/logout")
 def logout():
     flask.session.clear()
     return flask.redirect(flask.url_for("index"))
 
 
-# test
+# async: same pages, but storage calls are awaited, so a slow backend can
+# be hit concurrently within one request. NOTE: under WSGI each async view
+# still holds a worker thread (Flask runs it in its own event loop); the win
+# is overlapping I/O inside a request. Needs `flask[async]` (asgiref)
 
 
-def test_unit__get_user__fail_missing():
-    sto = StorageMem()
-    assert not sto.get_user("a")
+class StorageAsync(abc.ABC):
+    @abc.abstractmethod
+    async def get_user(self, user: str) -> bool:
+        pass
 
+    @abc.abstractmethod
+    async def add_user(self, user: str) -> None:
+        pass
 
-def test_unit__add_user__get_user_success():
-    sto = StorageMem()
-    sto.add_user("a")
-    assert sto.get_user("a")
+    @abc.abstractmethod
+    async def get_cred(self, user: str) -> T.Optional[str]:
+        pass
 
+    @abc.abstractmethod
+    async def set_cred(self, user: str, cred: str) -> None:
+        pass
 
-def test_unit__get_cred__fail_missing():
-    sto = StorageMem()
-    sto.add_user("a")
-    assert not sto.get_cred("a")
+    @abc.abstractmethod
+    async def get_messages(self, user: str) -> T.Optional[list[Message]]:
+        pass
 
+    @abc.abstractmethod
+    async def get_messages_page(
+        self, user: str, cursor: T.Optional[int], limit: int
+    ) -> MessagePage:
+        pass
 
-def test_unit__set_cred__get_cred_success():
-    sto = StorageMem()
-    sto.add_user("a")
-    sto.set_cred("a", "1234")
-    assert sto.get_cred("a") == "1234"
+    @abc.abstractmethod
+    async def add_message(self, user: str, msg: Message) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def get_version(self, user: str) -> int:
+        pass
+
+
+STORAGE_ASYNC_POOL = concurrent.futures.ThreadPoolExecutor(
+    int(os.environ.get("STORAGE_ASYNC_WORKERS", 32)),
+    thread_name_prefix="storage",
+)
+
+
+# Sync Storage -> StorageAsync. With offload, each call runs on a thread so
+# a blocking backend doesn't stall the loop; StorageMem doesn't need it
+class StorageAsyncAdapter:
+    def __init__(self, sto: Storage, offload: bool = True) -> None:
+        self.sto = sto
+        self.offload = offload
+
+    async def call(self, fn: T.Callable, *args: T.Any) -> T.Any:
+        import asyncio
+
+        if self.offload:
+            # a shared pool: Flask makes a new event loop per request, and a
+            # loop's default executor would mean new threads per request
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(STORAGE_ASYNC_POOL, fn, *args)
+        return fn(*args)
 
+    async def get_user(self, user: str) -> bool:
+        return await self.call(self.sto.get_user, user)
 
-def test_integration__get_body_template__success_w_user():
-    user = "abcdefg"
-    # can't use helper - it calls flask, doesn't work outside an `app`!
-    # params = get_body_params("", "", "", user)
-    _ = ""
-    params = ParamsBody(_, _, _, _, _, _, _, user)
-    result = get_body_template(params)
-    assert "logout" in result
-    assert user in result
+    async def add_user(self, user: str) -> None:
+        await self.call(self.sto.add_user, user)
+
+    async def get_cred(self, user: str) -> T.Optional[str]:
+        return await self.call(self.sto.get_cred, user)
+
+    async def set_cred(self, user: str, cred: str) -> None:
+        await self.call(self.sto.set_cred, user, cred)
+
+    async def get_messages(self, user: str) -> T.Optional[list[Message]]:
+        return await self.call(self.sto.get_messages, user)
+
+    async def get_messages_page(
+        self, user: str, cursor: T.Optional[int], limit: int
+    ) -> MessagePage:
+        return await self.call(self.sto.get_messages_page, user, cursor, limit)
+
+    async def add_message(self, user: str, msg: Message) -> None:
+        await self.call(self.sto.add_message, user, msg)
+
+    async def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        await self.call(self.sto.add_messages_bulk, msgs)
+
+    async def get_version(self, user: str) -> int:
+        return await self.call(self.sto.get_version, user)
+
+
+StorageAsync.register(StorageAsyncAdapter)
+
+
+def get_storage_async() -> StorageAsync:
+    # cheap wrapper; built per call so it always follows the app's storage
+    offload = flask.current_app.config.get("STORAGE_ASYNC_OFFLOAD", True)
+    return StorageAsyncAdapter(get_storage_flask(), offload)
+
+
+@route("/async/")
+async def index_async():
+    # nothing to await; here so both paths can be load-tested side by side
+    user = flask.session.get("user")
+    content = "Hello, World!"
+    header = "index"
+    params = get_body_params("index", header, content, user)
+    return get_body_template(params)
+
+
+@route("/async/user/<user>")
+async def user_msg_async(user: str):
+    import asyncio
+
+    user = str(markupsafe.escape(user))
+    sto = get_storage_async()
+    cursor, limit = get_page_args()
+    # one round trip's worth of latency instead of two
+    exists, version = await asyncio.gather(
+        sto.get_user(user), sto.get_version(user)
+    )
+    if not exists:
+        flask.abort(404)
+    if user != flask.session.get("user"):
+        flask.abort(403)
+    etag = get_etag("user_msg", user, version, False, cursor, limit)
+    if flask.request.if_none_match.contains(etag):
+        return conditional(etag, lambda: "")  # a 304; never renders
+    # only read the page once we know it's wanted, like user_msg
+    page = await sto.get_messages_page(user, cursor, limit)
+
+    def render():
+        content = get_user_template_content(
+            page.messages,
+            get_page_url(user, page.prev_cursor, limit),
+            get_page_url(user, page.next_cursor, limit),
+        )
+        header = f"User {user}"
+        params = get_body_params("user", header, content, user)
+        return get_body_template(params)
+
+    return conditional(etag, render)
+
+
+@route("/async/login", methods=["POST"])
+@rate_limited("login_ip", get_client_ip)
+@rate_limited("login_user", get_form_username)
+async def login_post_async():
+    import asyncio
+
+    user = flask.request.form.get("username")
+    pswd = flask.request.form.get("password")
+    if user is None or pswd is None:
+        flask.abort(403)
+    cred = await get_storage_async().get_cred(user)
+    try:
+        # the KDF blocks (on the checker's pool); keep it off the loop
+        ok = await asyncio.to_thread(
+            flask.copy_current_request_context(check_cred_stored),
+            user,
+            cred,
+            pswd,
+        )
+    except TimeoutError:
+        flask.abort(503)
+    if ok:
+        flask.session.clear()
+        flask.session["user"] = user
+    return flask.redirect(flask.url_for("index"))
+
+
+# sending messages: the route only queues the write; a background thread
+# flushes the queue to storage in batches. Full queue -> 503, not a stall
+
+
+class WriteBehind:
+    def __init__(
+        self,
+        app: flask.Flask,
+        queue_size: int = 10_000,
+        flush_size: int = 500,
+        flush_interval: float = 0.05,
+    ) -> None:
+        self.app = app
+        self.queue: queue.Queue[tuple[str, Message]] = queue.Queue(queue_size)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.thread: T.Optional[threading.Thread] = None
+        self.thread_lock = threading.Lock()
+
+    def submit(self, user: str, msg: Message) -> bool:
+        # started on first write, so importing the app doesn't spawn threads
+        if self.thread is None:
+            with self.thread_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name="write-behind", daemon=True
+                    )
+                    self.thread.start()
+        try:
+            self.queue.put_nowait((user, msg))
+        except queue.Full:
+            return False
+        return True
+
+    def run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            # then gather more until the batch is full or the interval is up
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.app.extensions["storage"].add_messages_bulk(batch)
+            except Exception:
+                self.app.logger.exception(
+                    "Dropped %d queued messages", len(batch)
+                )
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self) -> None:
+        # blocks until everything queued so far is in storage
+        self.queue.join()
+
+
+def init_write_behind(app: flask.Flask, **kwargs: T.Any) -> WriteBehind:
+    wb = WriteBehind(app, **kwargs)
+    app.extensions["write_behind"] = wb
+    return wb
+
+
+MESSAGE_MAX_LEN = 4096
+
+
+@route("/user/<user>/messages", methods=["POST"])
+def user_msg_post(user: str):
+    user = str(markupsafe.escape(user))
+    frm = flask.session.get("user")
+    if frm is None:
+        flask.abort(403)
+    sto = get_storage_flask()
+    if not sto.get_user(user):
+        flask.abort(404)
+    text = flask.request.form.get("msg", "")
+    if not text or len(text) > MESSAGE_MAX_LEN:
+        flask.abort(400)
+    wb = flask.current_app.extensions["write_behind"]
+    if not wb.submit(user, Message(frm, text)):
+        flask.abort(
+            flask.Response(
+                "Too many messages, retry", 503, {"Retry-After": "1"}
+            )
+        )
+    # accepted, not yet stored: it lands with the next flush
+    return "", 202
+
+
+# sessions: the cookie only holds an opaque, random id; the data lives
+# server side. No HMAC/deserialise per request, and sessions can be revoked
+
+
+class SessionStore(abc.ABC):
+    # `data` is already serialized (by the session interface's serializer)
+    @abc.abstractmethod
+    def get(self, sid: str) -> T.Optional[str]:
+        pass
+
+    @abc.abstractmethod
+    def set(self, sid: str, data: str, expires: float) -> None:
+        pass
+
+    @abc.abstractmethod
+    def delete(self, sid: str) -> None:
+        pass
+
+    # drop everything expired at `now`, in one go; -> how many went
+    @abc.abstractmethod
+    def sweep(self, now: float) -> int:
+        pass
+
+    @abc.abstractmethod
+    def count(self, now: float) -> int:
+        pass
+
+
+# LRU: when full, the least recently used session is the one logged out
+class SessionStoreMem:
+    def __init__(self, max_entries: int = 100_000) -> None:
+        self.max_entries = max_entries
+        self.entries: collections.OrderedDict[str, tuple[float, str]] = (
+            collections.OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+    def get(self, sid: str) -> T.Optional[str]:
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[sid]
+                return None
+            self.entries.move_to_end(sid)
+            return entry[1]
+
+    def set(self, sid: str, data: str, expires: float) -> None:
+        with self.lock:
+            self.entries[sid] = (expires, data)
+            self.entries.move_to_end(sid)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid: str) -> None:
+        with self.lock:
+            self.entries.pop(sid, None)
+
+    def sweep(self, now: float) -> int:
+        with self.lock:
+            expired = [
+                sid for sid, (exp, _) in self.entries.items() if exp < now
+            ]
+            for sid in expired:
+                del self.entries[sid]
+            return len(expired)
+
+    def count(self, now: float) -> int:
+        with self.lock:
+            return sum(1 for exp, _ in self.entries.values() if exp >= now)
+
+
+SessionStore.register(SessionStoreMem)
+
+SQLITE_SESSIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    sid TEXT PRIMARY KEY,
+    expires REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+"""
+SQL_SESSION_GET = "SELECT data FROM sessions WHERE sid = ? AND expires >= ?"
+SQL_SESSION_SET = (
+    "INSERT INTO sessions (sid, expires, data) VALUES (?, ?, ?)"
+    " ON CONFLICT (sid) DO UPDATE"
+    " SET expires = excluded.expires, data = excluded.data"
+)
+SQL_SESSION_DELETE = "DELETE FROM sessions WHERE sid = ?"
+SQL_SESSION_SWEEP = "DELETE FROM sessions WHERE expires < ?"
+SQL_SESSION_COUNT = "SELECT count(*) FROM sessions WHERE expires >= ?"
+
+
+# survives restarts, and is shared by every worker process on the box
+class SessionStoreSQLite:
+    def __init__(self, path: str) -> None:
+        self.pool = SQLitePool(path)
+        with self.pool.conn() as conn:
+            conn.executescript(SQLITE_SESSIONS_SCHEMA)
+
+    def get(self, sid: str) -> T.Optional[str]:
+        with self.pool.conn() as conn:
+            row = conn.execute(SQL_SESSION_GET, (sid, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, sid: str, data: str, expires: float) -> None:
+        with self.pool.conn() as conn:
+            conn.execute(SQL_SESSION_SET, (sid, expires, data))
+
+    def delete(self, sid: str) -> None:
+        with self.pool.conn() as conn:
+            conn.execute(SQL_SESSION_DELETE, (sid,))
+
+    def sweep(self, now: float) -> int:
+        with self.pool.conn() as conn:
+            return conn.execute(SQL_SESSION_SWEEP, (now,)).rowcount
+
+    def count(self, now: float) -> int:
+        with self.pool.conn() as conn:
+            return conn.execute(SQL_SESSION_COUNT, (now,)).fetchone()[0]
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+SessionStore.register(SessionStoreSQLite)
+
+
+# same change tracking as Flask's cookie session, plus the id, and whether
+# it was cleared (login/logout do that) so it gets a fresh id on save
+class ServerSession(
+    werkzeug.datastructures.CallbackDict, flask.sessions.SessionMixin
+):
+    def __init__(
+        self, initial: T.Optional[dict], sid: str, new: bool = False
+    ) -> None:
+        def on_update(self: ServerSession) -> None:
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+        self.rotate = False
+
+    def __getitem__(self, key: str) -> T.Any:
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key: str, default: T.Any = None) -> T.Any:
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key: str, default: T.Any = None) -> T.Any:
+        self.accessed = True
+        return super().setdefault(key, default)
+
+    def clear(self) -> None:
+        # never carry an id across a login (session fixation)
+        self.rotate = True
+        super().clear()
+
+
+class ServerSessionInterface(flask.sessions.SessionInterface):
+    # the one Flask's cookie sessions use (SecureCookieSessionInterface)
+    serializer = flask.sessions.session_json_serializer
+
+    def __init__(self, store: SessionStore, sweep_interval: float = 60.0):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self.next_sweep = time.time() + sweep_interval
+
+    def open_session(
+        self, app: flask.Flask, request: flask.Request
+    ) -> ServerSession:
+        now = time.time()
+        if now >= self.next_sweep:
+            # good enough to not double up; a lost race just sweeps twice
+            self.next_sweep = now + self.sweep_interval
+            self.store.sweep(now)
+        sid = request.cookies.get(self.get_cookie_name(app))
+        raw = self.store.get(sid) if sid else None
+        if raw is not None:
+            # Flask's tagged JSON, like its cookie sessions: tuples, Markup,
+            # bytes, datetimes etc. come back as they went in
+            try:
+                return ServerSession(self.serializer.loads(raw), sid)
+            except ValueError:
+                pass  # unreadable: start over, as for an unknown id
+        return ServerSession(None, secrets.token_urlsafe(32), new=True)
+
+    def save_session(
+        self,
+        app: flask.Flask,
+        session: ServerSession,
+        response: flask.Response,
+    ) -> None:
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        if session.rotate and not session.new:
+            self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.store.set(
+            session.sid,
+            self.serializer.dumps(dict(session)),
+            time.time() + lifetime,
+        )
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def count(self) -> int:
+        return self.store.count(time.time())
+
+
+SESSION_BACKENDS: dict[str, T.Callable[[], SessionStore]] = {
+    "mem": SessionStoreMem,
+    "sqlite": lambda: SessionStoreSQLite(
+        os.environ.get("SESSION_SQLITE_PATH", "sessions.sqlite3")
+    ),
+}
+
+
+def init_sessions(app: flask.Flask, backend: str = "mem") -> None:
+    # "cookie" keeps Flask's own signed-cookie sessions
+    if backend == "cookie":
+        return
+    if backend not in SESSION_BACKENDS:
+        raise ValueError(f"Unknown session backend: {backend}")
+    app.session_interface = ServerSessionInterface(SESSION_BACKENDS[backend]())
+
+
+@command("sessions")
+def sessions_command():
+    """Sweep expired server-side sessions, then count the live ones."""
+    iface = flask.current_app.session_interface
+    if not isinstance(iface, ServerSessionInterface):
+        print("cookie sessions: nothing stored server side")
+        return
+    swept = iface.store.sweep(time.time())
+    print(f"swept {swept}, active {iface.count()}")
+
+
+@command("storage-server")
+def storage_server_command():
+    """Serve storage to workers running with STORAGE_BACKEND=remote."""
+    backend = os.environ.get("STORAGE_SERVER_BACKEND", "sharded")
+    sto = STORAGE_BACKENDS[backend]()
+    if not sto.list_users():
+        seed(sto)
+    if not getattr(sto, "threadsafe", False):
+        sto = StorageLocked(sto)
+    server = make_storage_server(
+        STORAGE_REMOTE_ADDRESS, get_remote_authkey(), sto
+    )
+    print(f"serving {backend} storage on {STORAGE_REMOTE_ADDRESS}")
+    server.serve_forever()
+
+
+# metrics, continued: the storage wrapper, the middleware, and /metrics
+
+
+# every Storage method as a span. Bound once, as instance attributes, so a
+# call is one lookup + the timing; nothing to override per method
+class StorageTimed:
+    def __init__(self, sto: Storage, metrics: Metrics) -> None:
+        self.sto = sto
+        self.threadsafe = getattr(sto, "threadsafe", False)
+        for name in Storage.__abstractmethods__:
+            fn = metrics.timed(f"storage.{name}", getattr(sto, name))
+            setattr(self, name, fn)
+
+
+Storage.register(StorageTimed)
+
+
+def get_server_timing(spans: dict[str, int], total_ns: int) -> str:
+    parts = [f"{name};dur={ns / 1e6:.3f}" for name, ns in spans.items()]
+    parts.append(f"total;dur={total_ns / 1e6:.3f}")
+    return ", ".join(parts)
+
+
+# Times each request to its headers (so, TTFB for streamed pages) by route,
+# and adds Server-Timing with the spans the request ran
+class MetricsMiddleware:
+    def __init__(self, wsgi_app: T.Callable, metrics: Metrics) -> None:
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        spans: dict[str, int] = {}
+        token = SPANS.set(spans)
+        start = time.perf_counter_ns()
+
+        def start_response_timed(status, headers, exc_info=None):
+            total_ns = time.perf_counter_ns() - start
+            # still inside Flask's request context here, so the rule is known
+            rule = (
+                flask.request.url_rule if flask.has_request_context() else None
+            )
+            route = rule.rule if rule is not None else "<unmatched>"
+            self.metrics.histogram("request", route).observe(total_ns)
+            headers.append(
+                ("Server-Timing", get_server_timing(spans, total_ns))
+            )
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.wsgi_app(environ, start_response_timed)
+        finally:
+            SPANS.reset(token)
+
+
+def init_metrics(
+    app: flask.Flask, metrics: T.Optional[Metrics]
+) -> T.Optional[Metrics]:
+    # after init_storage: wraps whatever storage the app already has
+    app.extensions["metrics"] = metrics
+    if metrics is not None:
+        sto = app.extensions["storage"]
+        app.extensions["storage"] = StorageTimed(sto, metrics)
+        app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics)
+    return metrics
+
+
+@route("/metrics")
+def metrics():
+    metrics = flask.current_app.extensions.get("metrics")
+    if metrics is None:
+        flask.abort(404)
+    limiters = flask.current_app.extensions.get("rate_limits", {})
+    cache = flask.current_app.extensions.get("page_cache")
+    return flask.Response(
+        metrics.render()
+        + render_rate_limit_metrics(limiters)
+        + render_page_cache_metrics(cache),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
+def render_rate_limit_metrics(limiters: dict[str, RateLimiter]) -> str:
+    lines = ["# TYPE pt7_rate_limit_total counter"]
+    for name, limiter in sorted(limiters.items()):
+        for result, count in limiter.stats().items():
+            lines.append(
+                f'pt7_rate_limit_total{{limiter="{name}",result="{result}"}}'
+                f" {count}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def render_page_cache_metrics(cache: T.Optional[PageCache]) -> str:
+    if cache is None:
+        return ""
+    stats = cache.stats()
+    lines = ["# TYPE pt7_page_cache_total counter"]
+    for event in ("hits", "misses", "evictions", "invalidations"):
+        lines.append(f'pt7_page_cache_total{{event="{event}"}} {stats[event]}')
+    for name in ("entries", "bytes", "max_bytes"):
+        lines.append(f"# TYPE pt7_page_cache_{name} gauge")
+        lines.append(f"pt7_page_cache_{name} {stats[name]}")
+    return "\n".join(lines) + "\n"
+
+
+# search: ranked, best match first; no paging, just a limit
+
+
+SEARCH_LIMIT_DEFAULT = 20
+
+
+def get_search_template_content(q: str, messages: list[Message]) -> str:
+    form = f"""
+<form method="get">
+    <label for="q">Search</label>
+    <input name="q" id="q" value="{html_escape(q)}">
+    <input type="submit" value="Search">
+</form>
+    """
+    return form + get_user_template_content(messages)
+
+
+@route("/user/<user>/search")
+@cached_page
+def user_msg_search(user: str):
+    user = str(markupsafe.escape(user))
+    sto = get_storage_flask()
+    if not sto.get_user(user):
+        flask.abort(404)
+    if user != flask.session.get("user"):
+        flask.abort(403)
+    q = flask.request.args.get("q", "")
+    try:
+        limit = int(flask.request.args.get("limit", SEARCH_LIMIT_DEFAULT))
+    except ValueError:
+        flask.abort(400)
+    if limit < 1:
+        flask.abort(400)
+    limit = min(limit, MESSAGES_LIMIT_MAX)
+    etag = get_etag("user_msg_search", user, sto.get_version(user), q, limit)
+
+    def render():
+        msgs = sto.search_messages(user, q, limit)
+        content = get_search_template_content(q, msgs)
+        params = get_body_params("search", f"Search {user}", content, user)
+        return get_body_template(params)
+
+    return conditional(etag, render)
+
+
+# live inbox: GET /user/<user>/events is a Server-Sent Events stream of
+# new messages. Storage writes publish to an in-process broker, which fans
+# out to every subscriber's bounded buffer. Publishing never waits: a
+# subscriber whose buffer is full is dropped (told so, then disconnected;
+# browsers reconnect on their own and can refetch the page).
+# NOTE: per process. With STORAGE_BACKEND=remote, only this worker's
+# writes show up
+
+
+EVENTS_BUFFER = 256
+EVENTS_KEEPALIVE = 15.0  # seconds; also how soon a dead client is noticed
+
+
+class Subscription:
+    def __init__(self, user: str, size: int = EVENTS_BUFFER) -> None:
+        self.user = user
+        self.size = size
+        self.buf: collections.deque[Message] = collections.deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.dropped = False
+
+    def put(self, msg: Message) -> bool:
+        with self.cond:
+            if len(self.buf) >= self.size:
+                self.dropped = True
+            else:
+                self.buf.append(msg)
+            self.cond.notify()
+            return not self.dropped
+
+    def get(self, timeout: float) -> T.Optional[list[Message]]:
+        # everything buffered ([] on timeout); None once dropped
+        with self.cond:
+            if not self.buf and not self.dropped:
+                self.cond.wait(timeout)
+            if self.dropped:
+                return None
+            msgs = list(self.buf)
+            self.buf.clear()
+            return msgs
+
+
+class Broker:
+    def __init__(self) -> None:
+        self.subs: dict[str, set[Subscription]] = {}
+        self.lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, user: str, size: int = EVENTS_BUFFER) -> Subscription:
+        sub = Subscription(user, size)
+        with self.lock:
+            self.subs.setdefault(user, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self.lock:
+            subs = self.subs.get(sub.user)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self.subs[sub.user]
+
+    def publish(self, user: str, msg: Message) -> None:
+        subs = self.subs.get(user)
+        if not subs:
+            return  # the usual case; no lock
+        with self.lock:
+            subs = list(subs)
+        self.published += 1
+        for sub in subs:
+            if not sub.put(msg):
+                self.dropped += 1
+                self.unsubscribe(sub)
+
+    def count(self) -> int:
+        with self.lock:
+            return sum(map(len, self.subs.values()))
+
+
+# publishes after each write; everything else is passed straight through
+class StoragePublished:
+    def __init__(self, sto: Storage, broker: Broker) -> None:
+        self.sto = sto
+        self.broker = broker
+        self.threadsafe = getattr(sto, "threadsafe", False)
+        for name in Storage.__abstractmethods__ - {
+            "add_message",
+            "add_messages_bulk",
+        }:
+            setattr(self, name, getattr(sto, name))
+
+    def add_message(self, user: str, msg: Message) -> None:
+        self.sto.add_message(user, msg)
+        self.broker.publish(user, msg)
+
+    def add_messages_bulk(self, msgs: list[tuple[str, Message]]) -> None:
+        self.sto.add_messages_bulk(msgs)
+        for user, msg in msgs:
+            self.broker.publish(user, msg)
+
+
+Storage.register(StoragePublished)
+
+
+def init_events(app: flask.Flask) -> Broker:
+    # after init_storage: wraps whatever storage the app already has
+    broker = Broker()
+    app.extensions["events"] = broker
+    sto = app.extensions["storage"]
+    app.extensions["storage"] = StoragePublished(sto, broker)
+    return broker
+
+
+def iter_events(
+    broker: Broker, sub: Subscription, keepalive: float = EVENTS_KEEPALIVE
+) -> T.Iterator[str]:
+    try:
+        yield ": connected\n\n"  # gets the headers out now
+        while True:
+            msgs = sub.get(keepalive)
+            if msgs is None:
+                yield "event: dropped\ndata:\n\n"
+                return
+            if not msgs:
+                yield ": keepalive\n\n"
+            for msg in msgs:
+                data = json.dumps({"frm": msg.frm, "msg": msg.msg})
+                yield f"event: message\ndata: {data}\n\n"
+    finally:
+        # also runs when the server closes us (client went away)
+        broker.unsubscribe(sub)
+
+
+@route("/user/<user>/events")
+def user_msg_events(user: str):
+    user = str(markupsafe.escape(user))
+    if not get_storage_flask().get_user(user):
+        flask.abort(404)
+    if user != flask.session.get("user"):
+        flask.abort(403)
+    broker = flask.current_app.extensions["events"]
+    sub = broker.subscribe(user)
+    return flask.Response(
+        iter_events(broker, sub),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# app factory: config is the env vars below, overridden by `config`. Nothing
+# is built at import; `app` (for `flask run`, and `from pt7.app import app`)
+# is made on first access. Tests live in test_app.py, so pytest isn't
+# imported here either
+
+
+def get_env_config() -> dict[str, T.Any]:
+    env = os.environ
+    return {
+        "SECRET_KEY": env.get("FLASK_SECRET_KEY"),
+        "STORAGE_BACKEND": env.get("STORAGE_BACKEND", "mem"),
+        "SESSION_BACKEND": env.get("SESSION_BACKEND", "mem"),
+        "PAGE_CACHE_BYTES": int(env.get("PAGE_CACHE_BYTES", 16 * 2**20)),
+        "CRED_WORKERS": int(env.get("CRED_WORKERS", 4)),
+        "CRED_CACHE_TTL": float(env.get("CRED_CACHE_TTL", 300)),
+        "MESSAGE_QUEUE_SIZE": int(env.get("MESSAGE_QUEUE_SIZE", 10_000)),
+        "MESSAGE_FLUSH_SIZE": int(env.get("MESSAGE_FLUSH_SIZE", 500)),
+        "MESSAGE_FLUSH_INTERVAL": float(
+            env.get("MESSAGE_FLUSH_INTERVAL", 0.05)
+        ),
+        # limiter name -> "burst/seconds"; see parse_rate
+        "RATE_LIMITS": {
+            "login_ip": env.get("RATE_LIMIT_LOGIN_IP", "20/60"),
+            "login_user": env.get("RATE_LIMIT_LOGIN_USER", "10/60"),
+        },
+        # NOTE: @timed spans are only there if METRICS was set at import
+        "METRICS": METRICS is not None,
+    }
+
+
+def create_app(config: T.Optional[T.Mapping[str, T.Any]] = None) -> App:
+    app = App(__name__)
+    app.config.update(get_env_config())
+    app.config.update(config or {})
+    cfg = app.config
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    for cmd in COMMANDS:
+        app.cli.add_command(cmd)
+    init_cred_checker(
+        app, workers=cfg["CRED_WORKERS"], ttl=cfg["CRED_CACHE_TTL"]
+    )
+    init_storage(app, cfg["STORAGE_BACKEND"])
+    init_page_cache(app, cfg["PAGE_CACHE_BYTES"])
+    init_write_behind(
+        app,
+        queue_size=cfg["MESSAGE_QUEUE_SIZE"],
+        flush_size=cfg["MESSAGE_FLUSH_SIZE"],
+        flush_interval=cfg["MESSAGE_FLUSH_INTERVAL"],
+    )
+    init_events(app)
+    init_sessions(app, cfg["SESSION_BACKEND"])
+    init_rate_limits(app, cfg["RATE_LIMITS"])
+    init_metrics(app, (METRICS or Metrics()) if cfg["METRICS"] else None)
+    return app
 
 
-def test_integration__get_body_template__success_wo_user():
-    user = None
-    _ = ""
-    params = ParamsBody(_, _, _, _, _, _, _, user)
-    result = get_body_template(params)
-    assert "login" in result
-    assert str(user) not in result
+APP_LOCK = threading.Lock()
 
 
-@pytest.mark.skip(reason="fails on purpose")
-def test_fail():
-    raise ValueError("ALWAYS BLUE: yellow")
+def __getattr__(name: str) -> T.Any:
+    # module-level __getattr__ only runs for names the module doesn't have
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with APP_LOCK:
+        if "app" not in globals():
+            globals()["app"] = create_app()
+    return globals()["app"]